@@ -0,0 +1,283 @@
+"""
+Micro-benchmarks for the grading hot path: parse_text, parse_tokens,
+calculate_similarity, answer-key compilation, line alignment and the
+line-by-line report, on generated 10-, 50- and 200-line homeworks in Latin
+and Cyrillic script with noisy numbering.
+
+For every case it records time per call (best of several repeats) and the
+peak memory allocated by one call (tracemalloc). Results are compared with
+a saved baseline and the run fails (exit code 1) when a case got slower or
+allocates more than the tolerance allows. Before timing anything, the
+current normalizer is checked against the original regex-based parse_text
+on normalizer_check.py's corpus plus the generated homeworks (exit code 2
+on any difference).
+
+Usage:
+    python benchmarks/grading_bench.py --save-baseline     # record benchmarks/grading-baseline.json
+    python benchmarks/grading_bench.py                     # compare with it, fail on regressions
+    python benchmarks/grading_bench.py --tolerance 0.1 --quick
+    python benchmarks/grading_bench.py --filter "align_answers | 200"   # matches "name | corpus"
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import normalizer_check
+from normalizer_check import legacy_parse_text, load_prime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+# Tracked in git (unlike RESULTS_DIR), so a fresh checkout has something to compare with
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "grading-baseline.json")
+
+LINE_COUNTS = (10, 50, 200)
+LATIN_WORDS = [
+    "a", "b", "c", "d", "true", "false", "not given", "yes", "no", "receive",
+    "necessary", "environment", "government", "accommodation", "library",
+    "the museum", "twenty five", "on Monday", "by bus", "photography",
+]
+CYRILLIC_WORDS = [
+    "а", "б", "в", "г", "верно", "неверно", "не указано", "да", "нет", "получать",
+    "необходимый", "окружающая среда", "правительство", "кутубхона", "музей",
+    "двадцать пять", "в понедельник", "на автобусе", "фотография", "тошкент",
+]
+# Ways students (and teachers) number their lines
+NUMBERING = ["{n}. ", "{n}.", "{n}) ", "{n} - ", "{n}-", "{n}: ", " {n} . ", "{n}", "", "#{n} "]
+
+
+################################################################################
+# Reference implementations (as originally shipped in prime.py; parse_text is in normalizer_check.py)
+################################################################################
+
+def legacy_generate_line_by_line_report(teacher_raw: str, student_raw: str) -> str:
+    teacher_lines = teacher_raw.splitlines()
+    student_lines = student_raw.splitlines()
+    report_lines = []
+    for i in range(max(len(teacher_lines), len(student_lines))):
+        t_line_raw = teacher_lines[i] if i < len(teacher_lines) else ""
+        s_line_raw = student_lines[i] if i < len(student_lines) else ""
+        t_line_parsed = legacy_parse_text(t_line_raw)
+        s_line_parsed = legacy_parse_text(s_line_raw)
+        is_correct = (t_line_parsed == s_line_parsed and t_line_parsed.strip() != "")
+        report_lines.append(f"{i+1}. {s_line_raw.strip()} --> {'✅' if is_correct else '❌'}")
+    return "\n".join(report_lines)
+
+
+################################################################################
+# Corpora
+################################################################################
+
+def make_homework(lines, words, seed):
+    """
+    (answer key, student submission) with `lines` items. The key is cleanly
+    numbered; the submission uses mixed numbering, random case, stray
+    punctuation and spacing, ~20% wrong answers, a skipped and an extra line.
+    """
+    rng = random.Random(seed)
+    answers = [rng.choice(words) for _ in range(lines)]
+    key = "\n".join(f"{n}. {answer}" for n, answer in enumerate(answers, start=1))
+    student_lines = []
+    for n, answer in enumerate(answers, start=1):
+        if rng.random() < 0.2:
+            answer = rng.choice(words)
+        if rng.random() < 0.3:
+            answer = answer.upper() if rng.random() < 0.5 else answer.capitalize()
+        if rng.random() < 0.2:
+            answer += rng.choice([".", "!", ",", " ;", "  "])
+        student_lines.append(rng.choice(NUMBERING).format(n=n) + answer)
+    del student_lines[rng.randrange(len(student_lines))]
+    student_lines.insert(rng.randrange(len(student_lines) + 1), rng.choice(["", "Thank you!", "---"]))
+    return key, "\n".join(student_lines)
+
+def make_corpora():
+    corpora = {}
+    for script, words in (("latin", LATIN_WORDS), ("cyrillic", CYRILLIC_WORDS)):
+        for lines in LINE_COUNTS:
+            corpora[f"{lines}-{script}"] = make_homework(lines, words, seed=lines * 31 + len(script))
+    return corpora
+
+
+################################################################################
+# Runner
+################################################################################
+
+def check_equivalence(prime, corpora):
+    """Differences between the current normalizer and the reference one (empty if none)."""
+    samples = normalizer_check.corpus()
+    for key, student in corpora.values():
+        samples += [key, student] + student.splitlines()
+    problems = normalizer_check.check(prime, samples)
+    for key, student in corpora.values():
+        answer_key = prime.CompiledAnswerKey(key)
+        expected = prime.calculate_similarity(legacy_parse_text(student), legacy_parse_text(key))
+        if abs(answer_key.similarity(prime.parse_tokens(student), max_distance=0) - expected) > 1e-12:
+            problems.append(f"CompiledAnswerKey.similarity differs from calculate_similarity on {key[:20]!r}")
+    return problems
+
+def make_cases(prime, corpora):
+    """[(case name, corpus name, zero-argument callable)]"""
+    cases = []
+    for corpus, (key, student) in corpora.items():
+        answer_key = prime.CompiledAnswerKey(key)
+        tokens = prime.parse_tokens(student)
+        key_parsed = prime.parse_text(key)
+        student_parsed = prime.parse_text(student)
+        alignment = prime.align_answers(answer_key, student)
+
+        def grade(answer_key=answer_key, student=student):
+            # What process_homework_submission does per submission
+            student_tokens = prime.parse_tokens(student)
+            answer_key.similarity(student_tokens)
+            return prime.generate_line_by_line_report(prime.align_answers(answer_key, student))
+
+        cases += [
+            ("parse_text", corpus, lambda student=student: prime.parse_text(student)),
+            ("legacy parse_text", corpus, lambda student=student: legacy_parse_text(student)),
+            ("parse_tokens", corpus, lambda student=student: prime.parse_tokens(student)),
+            ("calculate_similarity", corpus,
+             lambda s=student_parsed, k=key_parsed: prime.calculate_similarity(s, k)),
+            ("compile answer key", corpus, lambda key=key: prime.CompiledAnswerKey(key)),
+            ("key similarity", corpus,
+             lambda answer_key=answer_key, tokens=tokens: answer_key.similarity(tokens, max_distance=0)),
+            ("key similarity (fuzzy k=1)", corpus,
+             lambda answer_key=answer_key, tokens=tokens: answer_key.similarity(tokens, max_distance=1)),
+            ("align_answers", corpus,
+             lambda answer_key=answer_key, student=student: prime.align_answers(answer_key, student)),
+            ("line report", corpus,
+             lambda alignment=alignment: prime.generate_line_by_line_report(alignment)),
+            ("legacy line report", corpus,
+             lambda key=key, student=student: legacy_generate_line_by_line_report(key, student)),
+            ("grade submission", corpus, grade),
+        ]
+    return cases
+
+def time_per_call(func, repeats):
+    """Best-of-`repeats` seconds per call, each repeat running ~0.2s worth of calls."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeats, number=number)) / number
+
+def peak_allocation(func):
+    """Peak bytes allocated while one call runs (after a warm-up call)."""
+    func()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(0, peak - before)
+
+def run_cases(cases, repeats):
+    results = {}
+    for name, corpus, func in cases:
+        seconds = time_per_call(func, repeats)
+        results[f"{name} | {corpus}"] = {
+            "case": name,
+            "corpus": corpus,
+            "us_per_call": round(seconds * 1e6, 3),
+            "calls_per_second": round(1 / seconds, 1) if seconds else None,
+            "peak_alloc_bytes": peak_allocation(func),
+        }
+        print(f"{name:<28} {corpus:<14} {seconds * 1e6:>11.2f} us/call "
+              f"{results[f'{name} | {corpus}']['peak_alloc_bytes']:>10} B peak")
+    return results
+
+def find_regressions(baseline, results, tolerance, alloc_tolerance, min_alloc_delta=1024):
+    """Cases slower or allocating more than the baseline beyond the tolerances."""
+    regressions = []
+    for case, current in results.items():
+        previous = baseline.get(case)
+        if previous is None:
+            continue
+        if current["us_per_call"] > previous["us_per_call"] * (1 + tolerance):
+            regressions.append(
+                f"{case}: {previous['us_per_call']} -> {current['us_per_call']} us/call "
+                f"(+{(current['us_per_call'] / previous['us_per_call'] - 1) * 100:.0f}%)"
+            )
+        grown = current["peak_alloc_bytes"] - previous["peak_alloc_bytes"]
+        if grown > min_alloc_delta and current["peak_alloc_bytes"] > previous["peak_alloc_bytes"] * (1 + alloc_tolerance):
+            regressions.append(
+                f"{case}: peak allocation {previous['peak_alloc_bytes']} -> {current['peak_alloc_bytes']} bytes"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown (0.25 = 25%%)")
+    parser.add_argument("--alloc-tolerance", type=float, default=0.25, help="allowed growth of peak allocation")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="fewer repeats (noisier)")
+    parser.add_argument("--filter", help='only cases whose "name | corpus" key contains this text')
+    parser.add_argument("--output", help="results file (default: benchmarks/results/grading-<timestamp>.json)")
+    args = parser.parse_args()
+    if args.filter and args.save_baseline:
+        parser.error("--save-baseline records every case; it can't be combined with --filter")
+
+    workdir = tempfile.mkdtemp(prefix="srm-bench-")
+    try:
+        prime = load_prime(workdir)
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    corpora = make_corpora()
+    problems = check_equivalence(prime, corpora)
+    if problems:
+        print("NORMALIZER MISMATCH against the reference implementation:")
+        for problem in problems[:20]:
+            print("  " + problem)
+        sys.exit(2)
+    print("Normalizer matches the reference parse_text on all corpora.\n")
+
+    cases = make_cases(prime, corpora)
+    if args.filter:
+        cases = [case for case in cases if args.filter in f"{case[0]} | {case[1]}"]
+        if not cases:
+            parser.error(f"no case matches --filter {args.filter!r}")
+    results = run_cases(cases, 2 if args.quick else args.repeats)
+
+    run = {"timestamp": datetime.now().isoformat(timespec="seconds"), "python": sys.version.split()[0], "cases": results}
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"grading-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as results_file:
+        json.dump(run, results_file, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(run, baseline_file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one.")
+        return
+    with open(args.baseline, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = find_regressions(baseline["cases"], results, args.tolerance, args.alloc_tolerance)
+    if regressions:
+        print(f"\nREGRESSIONS against the baseline from {baseline['timestamp']}:")
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
+    print(f"\nNo regressions against the baseline from {baseline['timestamp']} "
+          f"(tolerance {args.tolerance:.0%} time, {args.alloc_tolerance:.0%} allocation).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+End-to-end load test: synthetic student traffic fed through the bot's
+dispatcher, against a mocked Telegram Bot API and the in-memory Sheets
+stand-in (fake_sheets.py), so no network access is needed.
+
+Every round, each demo student opens /homework, picks a homework, submits
+answers (some lines wrong), then presses "My points" and "Top List"; new
+users go through the whole registration flow, and an admin broadcasts to
+{ALL}. Reports p50/p95/p99 handler latency per step, Sheets calls per
+update, Telegram requests, event-loop lag and updates per second, and
+saves them as JSON so runs can be compared between versions.
+
+Usage:
+    python benchmarks/load_harness.py --students 100 --rounds 3 --sheets-latency 0.15
+    python benchmarks/load_harness.py --compare benchmarks/results/load-20250101-120000.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+# Any syntactically valid token; requests never leave the process
+FAKE_BOT_TOKEN = "123456:LOADTESTloadtestLOADTESTloadtest000"
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers (0.0 if empty)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(max(samples, default=0.0) * 1000, 3),
+    }
+
+
+def load_bot(args, workdir):
+    """Import prime.py wired to the fake Sheets backend, with its state files in workdir."""
+    os.environ["SHEETS_BACKEND"] = "fake"
+    os.environ.setdefault("BOT_TOKEN", FAKE_BOT_TOKEN)
+    os.environ["FAKE_SHEETS_LATENCY"] = args.sheets_latency
+    # Quota errors are switched on after startup (see run()); the bot can't start without its sheets
+    os.environ["FAKE_SHEETS_ERROR_RATE"] = "0"
+    os.environ["FAKE_SHEETS_GROUPS"] = str(args.groups)
+    os.environ["FAKE_SHEETS_STUDENTS"] = str(max(1, math.ceil(args.students / args.groups)))
+    # prime.py keeps its journal and SQLite files in the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import prime
+    logging.getLogger().setLevel(logging.WARNING)
+    return prime
+
+
+def make_session_class():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message
+
+    class MockTelegramSession(BaseSession):
+        """Answers Bot API requests locally after `latency` seconds, counting them by method."""
+
+        def __init__(self, latency=0.0):
+            super().__init__()
+            self.latency = latency
+            self.calls = Counter()
+            self.send_latencies = []
+            self.message_ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            started = time.perf_counter()
+            name = type(method).__name__
+            self.calls[name] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if name.startswith("Send"):
+                result = Message(
+                    message_id=next(self.message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=getattr(method, "chat_id", 0) or 0, type="private"),
+                    text=getattr(method, "text", None),
+                )
+            else:
+                result = True
+            self.send_latencies.append(time.perf_counter() - started)
+            return result
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            if False:
+                yield b""
+
+    return MockTelegramSession
+
+
+class Traffic:
+    """Builds synthetic Updates, feeds them through the dispatcher and times each one."""
+
+    def __init__(self, prime, bot, seed):
+        from aiogram import types
+        self.types = types
+        self.prime = prime
+        self.bot = bot
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    async def send(self, step, user_id, text=None, contact=None):
+        types = self.types
+        message = types.Message(
+            message_id=next(self.message_ids),
+            date=datetime.now(),
+            chat=types.Chat(id=user_id, type="private"),
+            from_user=types.User(id=user_id, is_bot=False, first_name="Load", username=f"load{user_id}"),
+            text=text,
+            contact=contact,
+        )
+        update = types.Update(update_id=next(self.update_ids), message=message)
+        started = time.perf_counter()
+        try:
+            await self.prime.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.errors[f"{step}: {type(e).__name__}"] += 1
+        self.latencies[step].append(time.perf_counter() - started)
+
+    async def think(self, max_seconds):
+        if max_seconds:
+            await asyncio.sleep(self.random.uniform(0, max_seconds))
+
+    async def register(self, user_id, think):
+        contact = self.types.Contact(phone_number=f"+99890{user_id % 10000000:07}", first_name="Load", user_id=user_id)
+        steps = [
+            ("register:/start", "/start", None),
+            ("register:name", "Load User", None),
+            ("register:phone", None, contact),
+            ("register:extra phone", "No", None),
+            ("register:birth date", "01/01/2000", None),
+            ("register:region", "Tashkent City", None),
+            ("register:study mode", "Active", None),
+            ("register:hw frequency", "6 times per week", None),
+            ("register:referral", "Telegram Advertisement", None),
+        ]
+        for step, text, contact_value in steps:
+            await self.send(step, user_id, text, contact_value)
+            await self.think(think)
+
+    async def student_round(self, number, hw_num, think, wrong_lines):
+        import fake_sheets
+        _, telegram_id, _ = fake_sheets.demo_student(number)
+        answers = fake_sheets.demo_answer_key(hw_num).splitlines()
+        for i in self.random.sample(range(len(answers)), min(wrong_lines, len(answers))):
+            answers[i] = f"{i + 1}. {self.random.choice(fake_sheets.DEMO_ANSWERS)}"
+        steps = [
+            ("/homework", "/homework"),
+            ("homework selection", f"#{hw_num}"),
+            ("homework submission", "\n".join(answers)),
+            ("my points", "My points"),
+            ("top list", "Top List"),
+        ]
+        for step, text in steps:
+            await self.send(step, telegram_id, text)
+            await self.think(think)
+
+
+async def measure_loop_lag(samples, interval=0.01):
+    """Record how late a short sleep wakes up; large values mean the event loop was blocked."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+async def run(args, prime):
+    MockTelegramSession = make_session_class()
+    session = MockTelegramSession(args.telegram_latency)
+    bot = prime.Bot(token=os.environ["BOT_TOKEN"], session=session)
+    # Handlers that message other chats use the module-level bot
+    prime.bot = bot
+    prime.dp.include_router(prime.router)
+    await prime.on_startup()
+
+    traffic = Traffic(prime, bot, args.seed)
+    limits = prime.client.limits
+    limits.reset()
+    limits.error_rate = args.sheets_error_rate
+    lag_samples = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag_samples))
+    admin_id = prime.ADMIN_IDS[0]
+    new_user_ids = itertools.count(900000001)
+
+    started = time.perf_counter()
+    for round_number in range(args.rounds):
+        hw_num = round_number % 5 + 1
+        tasks = [
+            traffic.student_round(number, hw_num, args.think, args.wrong_lines)
+            for number in range(1, args.students + 1)
+        ]
+        tasks += [traffic.register(next(new_user_ids), args.think) for _ in range(args.registrations)]
+        if args.broadcast:
+            tasks.append(traffic.send("/message {ALL}", admin_id, f"/message Load test round {round_number + 1} {{ALL}}"))
+        await asyncio.gather(*tasks)
+    traffic_seconds = time.perf_counter() - started
+
+    # Let background broadcasts finish, then flush queued grades like a normal shutdown
+    while prime.broadcaster.jobs:
+        await asyncio.sleep(0.05)
+    lag_task.cancel()
+    await prime.on_shutdown()
+    total_seconds = time.perf_counter() - started
+
+    all_latencies = [sample for samples in traffic.latencies.values() for sample in samples]
+    updates = len(all_latencies)
+    sheet_calls = limits.total_calls()
+    sheet_calls_by_method = Counter()
+    for (method, _), count in limits.calls.items():
+        sheet_calls_by_method[method] += count
+    return {
+        "label": args.label,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "students": args.students,
+            "groups": args.groups,
+            "rounds": args.rounds,
+            "registrations_per_round": args.registrations,
+            "broadcast": args.broadcast,
+            "sheets_latency": args.sheets_latency,
+            "sheets_error_rate": args.sheets_error_rate,
+            "telegram_latency": args.telegram_latency,
+            "think": args.think,
+            "seed": args.seed,
+        },
+        "updates": updates,
+        "errors": dict(traffic.errors),
+        "traffic_seconds": round(traffic_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "updates_per_second": round(updates / traffic_seconds, 2) if traffic_seconds else 0.0,
+        "latency": summarize(all_latencies),
+        "latency_by_step": {step: summarize(samples) for step, samples in sorted(traffic.latencies.items())},
+        "sheet_calls": sheet_calls,
+        "sheet_calls_per_update": round(sheet_calls / updates, 3) if updates else 0.0,
+        "sheet_calls_by_method": dict(sheet_calls_by_method.most_common()),
+        "sheet_quota_errors": sum(limits.errors.values()),
+        "telegram_requests": dict(session.calls.most_common()),
+        "telegram_send_latency": summarize(session.send_latencies),
+        "event_loop_lag": summarize(lag_samples),
+        "gateway": prime.sheets.stats(),
+        "grade_queue": prime.grade_queue.stats(),
+    }
+
+
+def print_report(result):
+    print(f"{result['updates']} updates in {result['traffic_seconds']}s "
+          f"({result['updates_per_second']} updates/s), {result['sheet_calls']} Sheets calls "
+          f"({result['sheet_calls_per_update']} per update), {result['sheet_quota_errors']} quota errors")
+    print(f"{'step':<28} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = list(result["latency_by_step"].items()) + [("ALL", result["latency"]), ("event loop lag", result["event_loop_lag"])]
+    for step, stats in rows:
+        print(f"{step:<28} {stats['count']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} "
+              f"{stats['p99_ms']:>9} {stats['max_ms']:>9}")
+    if result["errors"]:
+        print("Handler errors:", result["errors"])
+
+def print_comparison(baseline, result):
+    """Relative change of the headline numbers against a saved run."""
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"\nCompared with {baseline.get('label') or 'baseline'} ({baseline.get('timestamp')}):")
+    for name, old, new in [
+        ("updates/s", baseline["updates_per_second"], result["updates_per_second"]),
+        ("Sheets calls/update", baseline["sheet_calls_per_update"], result["sheet_calls_per_update"]),
+        ("p50 ms", baseline["latency"]["p50_ms"], result["latency"]["p50_ms"]),
+        ("p95 ms", baseline["latency"]["p95_ms"], result["latency"]["p95_ms"]),
+        ("p99 ms", baseline["latency"]["p99_ms"], result["latency"]["p99_ms"]),
+        ("loop lag p99 ms", baseline["event_loop_lag"]["p99_ms"], result["event_loop_lag"]["p99_ms"]),
+    ]:
+        print(f"  {name:<22} {old:>10} -> {new:<10} {change(old, new)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--students", type=int, default=100, help="concurrent demo students per round")
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--registrations", type=int, default=5, help="new users registering per round")
+    parser.add_argument("--no-broadcast", dest="broadcast", action="store_false", help="skip /message {ALL}")
+    parser.add_argument("--sheets-latency", default="0.1", help='seconds per Sheets call, or a range like "0.05-0.3"')
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0, help="share of Sheets calls failing with 429")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="seconds per Bot API request")
+    parser.add_argument("--think", type=float, default=0.0, help="max random pause between a user's messages")
+    parser.add_argument("--wrong-lines", type=int, default=2, help="wrong answer lines per submission")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="", help="name stored with the results (e.g. a git revision)")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/load-<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="srm-load-")
+    try:
+        prime = load_bot(args, workdir)
+        result = asyncio.run(run(args, prime))
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            print_comparison(json.load(baseline_file), result)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as results_file:
+        json.dump(result, results_file, indent=2)
+    print(f"\nResults saved to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Regression check for the answer-text normalizer: prime.parse_text and
+prime.parse_tokens must give exactly the output of the original regex-based
+parse_text (kept below as the reference) on a fixed corpus of Latin,
+Cyrillic, mixed-script and numbered answer lines, plus a seeded set of
+random strings. grading_bench.py runs the same check before timing.
+
+Usage:
+    python benchmarks/normalizer_check.py      # exit code 1 on any difference
+"""
+
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_BOT_TOKEN = "123456:BENCHMARKbenchmarkBENCHMARKbench00"
+
+
+def legacy_parse_text(raw_text: str) -> str:
+    """parse_text as originally shipped in prime.py."""
+    only_letters = re.sub(r"[^a-zA-Z\s]+", "", raw_text)
+    lower_text = only_letters.lower()
+    lines = lower_text.split("\n")
+    cleaned_lines = []
+    for line in lines:
+        line = re.sub(r"^\d+(\.|-|\))?\s*", "", line.strip())
+        if line:
+            cleaned_lines.append(line)
+    return " ".join(cleaned_lines)
+
+
+FIXED_CORPUS = [
+    # Empty and whitespace only
+    "", " ", "\n", "\n\n\n", "\t \r\n ",
+    # Latin, numbered every way students number lines
+    "1. a\n2. b\n3. Word, test!",
+    "1.a\n2)b\n3 - c\n4-d\n5: e\n 6 . f\n7 g\n#8 h",
+    "1. TRUE\n2. False\n3. Not Given\n4. not given.",
+    "12) Hello  \r\n3-x\r\n\r\n",
+    "1. the museum\n2. on Monday!!\n3. by bus;\n4. twenty-five\n5. 25",
+    "A) necessary B) environment C) accommodation",
+    "1. receive 2. recieve 3. RECEIVE",
+    "tab\tseparated\twords\n\n5.",
+    "10.\n11.\n12. x",
+    # Cyrillic (dropped by the normalizer, like the original)
+    "1. а\n2. б\n3. в\n4. г",
+    "1. верно\n2. неверно\n3. не указано",
+    "Тошкент, кутубхона, музей.",
+    # Mixed scripts in one text and in one word
+    "1. a / а\n2. b (б)\n3. Музей museum",
+    "1. mixedСловоword\n2. КиРиЛлИцА latin",
+    "Ünïcödé 1. ß café naïve",
+    # Unicode whitespace and line separators
+    "a\u00a0b\u2003c\u3000d",
+    "1. a\u2028 2. b\u2029 3. c\x0b4. d\x0c5. e\x856. f",
+    "1. a\r2. b\r\n3. c",
+    # Digits and punctuation only
+    "1. 1990\n2. 25\n3. 3.14",
+    "!!!???...,,,;;;---",
+]
+RANDOM_ALPHABET = "abcXYZ \u0430\u0431\u0432\u0416\u0401 0123456789 .,;:!?-()#\t\n\r\u00a0\u2003\u00e9\u00df\u00fc"
+RANDOM_SAMPLES = 5000
+RANDOM_SEED = 11
+
+
+def corpus():
+    """The fixed corpus followed by RANDOM_SAMPLES seeded random strings."""
+    rng = random.Random(RANDOM_SEED)
+    samples = list(FIXED_CORPUS)
+    for _ in range(RANDOM_SAMPLES):
+        samples.append("".join(rng.choice(RANDOM_ALPHABET) for _ in range(rng.randrange(60))))
+    return samples
+
+def check(prime, samples=None):
+    """Differences between prime's normalizer and the reference one (empty if none)."""
+    problems = []
+    for text in corpus() if samples is None else samples:
+        expected = legacy_parse_text(text)
+        if prime.parse_text(text) != expected:
+            problems.append(f"parse_text({text[:40]!r}) = {prime.parse_text(text)!r}, expected {expected!r}")
+        if list(prime.parse_tokens(text)) != expected.split():
+            problems.append(f"parse_tokens({text[:40]!r}) differs from parse_text().split()")
+    return problems
+
+def load_prime(workdir):
+    """Import prime.py offline (fake Sheets backend, state files in workdir)."""
+    os.environ["SHEETS_BACKEND"] = "fake"
+    os.environ.setdefault("BOT_TOKEN", FAKE_BOT_TOKEN)
+    os.environ.setdefault("FAKE_SHEETS_GROUPS", "1")
+    os.environ.setdefault("FAKE_SHEETS_STUDENTS", "1")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import logging
+    import prime
+    logging.getLogger().setLevel(logging.WARNING)
+    return prime
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="srm-normalizer-")
+    try:
+        prime = load_prime(workdir)
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+    samples = corpus()
+    problems = check(prime, samples)
+    if problems:
+        print("NORMALIZER MISMATCH against the reference implementation:")
+        for problem in problems[:20]:
+            print("  " + problem)
+        sys.exit(1)
+    print(f"parse_text and parse_tokens match the reference on {len(samples)} samples "
+          f"({len(FIXED_CORPUS)} fixed, {RANDOM_SAMPLES} random).")
+
+if __name__ == "__main__":
+    main()
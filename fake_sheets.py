@@ -0,0 +1,347 @@
+"""
+In-memory stand-in for the parts of gspread that prime.py uses.
+
+Run the bot against it with SHEETS_BACKEND=fake (see prime.py); no Google
+access or google.json is needed. Every call can be slowed down and made to
+fail like the real API, so throughput work can be measured offline:
+
+    FAKE_SHEETS_LATENCY     seconds added to every call (e.g. "0.2", or "0.1-0.4" for a range)
+    FAKE_SHEETS_ERROR_RATE  share of calls failing with a 429 quota APIError (e.g. "0.05")
+    FAKE_SHEETS_SEED        JSON file {spreadsheet key: {tab title: [[cell, ...], ...]}}
+    FAKE_SHEETS_GROUPS      demo groups to generate when no seed file is given (default 4)
+    FAKE_SHEETS_STUDENTS    demo students per group (default 25)
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+from gspread.cell import Cell
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_to_rowcol, numericise_all, rowcol_to_a1
+
+
+class FakeLimits:
+    """
+    Latency and quota errors injected into every call.
+    latency is a number of seconds or a (min, max) range; calls run in the
+    bot's Sheets thread pool, so they sleep like blocking HTTP requests.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Metrics: (method, worksheet title) -> count
+        self.calls = Counter()
+        self.errors = Counter()
+
+    def apply(self, method, title):
+        with self.lock:
+            self.calls[(method, title)] += 1
+            latency = self.latency
+            if isinstance(latency, (tuple, list)):
+                latency = self.random.uniform(*latency)
+            failed = self.error_rate and self.random.random() < self.error_rate
+            if failed:
+                self.errors[(method, title)] += 1
+        if latency:
+            time.sleep(latency)
+        if failed:
+            raise quota_error(method)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.errors.clear()
+
+
+def quota_error(method):
+    """The APIError gspread raises when the per-minute read/write quota is exhausted."""
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps({
+        "error": {
+            "code": 429,
+            "message": f"Quota exceeded for quota metric 'Requests' ({method}, fake backend)",
+            "status": "RESOURCE_EXHAUSTED",
+        }
+    }).encode("utf-8")
+    return APIError(response)
+
+
+def _parse_range(a1_range):
+    """'B3:C5' or 'A4' -> (first row, first col, last row, last col), 1-based."""
+    if ":" in a1_range:
+        start, end = a1_range.split(":", 1)
+    else:
+        start = end = a1_range
+    first_row, first_col = a1_to_rowcol(start)
+    last_row, last_col = a1_to_rowcol(end)
+    return first_row, first_col, last_row, last_col
+
+
+class FakeWorksheet:
+    """One tab: a list of rows of strings, as the Sheets API returns them."""
+
+    def __init__(self, spreadsheet, title, values=None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.values = [[str(cell) for cell in row] for row in (values or [])]
+
+    @property
+    def id(self):
+        return self.spreadsheet.tabs.index(self)
+
+    def _call(self, method):
+        self.spreadsheet.limits.apply(method, self.title)
+
+    def _used_rows(self):
+        rows = len(self.values)
+        while rows and not any(cell != "" for cell in self.values[rows - 1]):
+            rows -= 1
+        return rows
+
+    def _set(self, row, col, value):
+        while len(self.values) < row:
+            self.values.append([])
+        cells = self.values[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = "" if value is None else str(value)
+
+    def _get(self, row, col):
+        if row <= len(self.values) and col <= len(self.values[row - 1]):
+            return self.values[row - 1][col - 1]
+        return ""
+
+    def _read(self, first_row, first_col, last_row, last_col):
+        """Values of a range, trimmed of trailing empty rows/cells like the API."""
+        last_row = min(last_row, self._used_rows())
+        rows = []
+        for row in range(first_row, last_row + 1):
+            cells = [self._get(row, col) for col in range(first_col, last_col + 1)]
+            while cells and cells[-1] == "":
+                cells.pop()
+            rows.append(cells)
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    # gspread Worksheet API
+
+    def get_all_values(self, **kwargs):
+        self._call("get_all_values")
+        rows = [list(row) for row in self.values[:self._used_rows()]]
+        width = max((len(row) for row in rows), default=0)
+        return [row + [""] * (width - len(row)) for row in rows]
+
+    def get_all_records(self, head=1, **kwargs):
+        self._call("get_all_records")
+        rows = [list(row) for row in self.values[:self._used_rows()]]
+        if len(rows) < head:
+            return []
+        headers = rows[head - 1]
+        records = []
+        for row in rows[head:]:
+            row = numericise_all(row + [""] * (len(headers) - len(row)), empty2zero=False, default_blank="")
+            records.append(dict(zip(headers, row)))
+        return records
+
+    def row_values(self, row, **kwargs):
+        self._call("row_values")
+        cells = list(self.values[row - 1]) if row <= len(self.values) else []
+        while cells and cells[-1] == "":
+            cells.pop()
+        return cells
+
+    def col_values(self, col, **kwargs):
+        self._call("col_values")
+        cells = [self._get(row, col) for row in range(1, self._used_rows() + 1)]
+        while cells and cells[-1] == "":
+            cells.pop()
+        return cells
+
+    def cell(self, row, col, **kwargs):
+        self._call("cell")
+        return Cell(row, col, self._get(row, col))
+
+    def update_cell(self, row, col, value):
+        self._call("update_cell")
+        self._set(row, col, value)
+        return {"updatedCells": 1}
+
+    def append_row(self, values, **kwargs):
+        self._call("append_row")
+        row = self._used_rows() + 1
+        for col, value in enumerate(values, start=1):
+            self._set(row, col, value)
+        last_col = max(1, len(values))
+        return {"updates": {
+            "updatedRange": f"'{self.title}'!{rowcol_to_a1(row, 1)}:{rowcol_to_a1(row, last_col)}",
+            "updatedRows": 1,
+            "updatedColumns": len(values),
+            "updatedCells": len(values),
+        }}
+
+    def batch_update(self, data, **kwargs):
+        self._call("batch_update")
+        updated = 0
+        for entry in data:
+            first_row, first_col, _, _ = _parse_range(entry["range"])
+            for r, row_values in enumerate(entry["values"]):
+                for c, value in enumerate(row_values):
+                    self._set(first_row + r, first_col + c, value)
+                    updated += 1
+        return {"totalUpdatedCells": updated}
+
+
+class FakeSpreadsheet:
+    """A spreadsheet: ordered tabs looked up by title."""
+
+    def __init__(self, client, key, tabs=None):
+        self.client = client
+        self.id = key
+        self.tabs = [FakeWorksheet(self, title, values) for title, values in (tabs or {}).items()]
+        if not self.tabs:
+            self.tabs.append(FakeWorksheet(self, "Sheet1"))
+
+    @property
+    def limits(self):
+        return self.client.limits
+
+    @property
+    def sheet1(self):
+        return self.tabs[0]
+
+    def worksheets(self, **kwargs):
+        self.limits.apply("worksheets", None)
+        return list(self.tabs)
+
+    def worksheet(self, title):
+        self.limits.apply("worksheet", title)
+        for ws in self.tabs:
+            if ws.title == title:
+                return ws
+        raise WorksheetNotFound(title)
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        self.limits.apply("add_worksheet", title)
+        ws = FakeWorksheet(self, title)
+        self.tabs.append(ws)
+        return ws
+
+    def values_batch_get(self, ranges, params=None, **kwargs):
+        self.limits.apply("values_batch_get", None)
+        value_ranges = []
+        for a1_range in ranges:
+            title, _, cells = a1_range.rpartition("!")
+            title = title.strip("'").replace("''", "'")
+            ws = next((ws for ws in self.tabs if ws.title == title), None)
+            if ws is None:
+                raise WorksheetNotFound(title)
+            value_ranges.append({"range": a1_range, "majorDimension": "ROWS",
+                                 "values": ws._read(*_parse_range(cells))})
+        return {"spreadsheetId": self.id, "valueRanges": value_ranges}
+
+
+class FakeClient:
+    """Stands in for the authorized gspread Client; unknown keys open an empty spreadsheet."""
+
+    def __init__(self, spreadsheets=None, limits=None):
+        self.limits = limits or FakeLimits()
+        self.spreadsheets = {}
+        for key, tabs in (spreadsheets or {}).items():
+            self.spreadsheets[key] = FakeSpreadsheet(self, key, tabs)
+
+    def open_by_key(self, key):
+        self.limits.apply("open_by_key", None)
+        if key not in self.spreadsheets:
+            self.spreadsheets[key] = FakeSpreadsheet(self, key)
+        return self.spreadsheets[key]
+
+    def dump(self):
+        """All cell values, in the FAKE_SHEETS_SEED format."""
+        return {
+            key: {ws.title: [list(row) for row in ws.values] for ws in spreadsheet.tabs}
+            for key, spreadsheet in self.spreadsheets.items()
+        }
+
+    @classmethod
+    def from_env(cls, registration_key, groups_key):
+        latency = os.environ.get("FAKE_SHEETS_LATENCY", "0")
+        if "-" in latency:
+            latency = tuple(float(bound) for bound in latency.split("-", 1))
+        else:
+            latency = float(latency)
+        limits = FakeLimits(latency, float(os.environ.get("FAKE_SHEETS_ERROR_RATE", "0")))
+        seed_path = os.environ.get("FAKE_SHEETS_SEED")
+        if seed_path:
+            with open(seed_path, encoding="utf-8") as seed_file:
+                spreadsheets = json.load(seed_file)
+        else:
+            spreadsheets = demo_spreadsheets(
+                registration_key, groups_key,
+                groups=int(os.environ.get("FAKE_SHEETS_GROUPS", "4")),
+                students_per_group=int(os.environ.get("FAKE_SHEETS_STUDENTS", "25")),
+            )
+        return cls(spreadsheets, limits)
+
+
+################################################################################
+# Demo data laid out like the production sheets
+################################################################################
+
+REGISTRATION_HEADERS = [
+    "Full Name", "Telephone Number", "Additional Telephone Number", "Username",
+    "Date of Birth", "Age Category", "Region", "Study Mode", "HW Frequency",
+    "Referral", "Unique ID", "Telegram ID", "Registration Time", "GROUP NUMBER",
+]
+DEMO_ANSWERS = ["a", "b", "c", "d", "true", "false", "not given", "receive", "necessary", "environment"]
+
+def demo_student(number):
+    """(Unique ID, Telegram ID, full name) of demo student #number (1-based)."""
+    return f"V{number:03}", 100000 + number, f"Student {number}"
+
+def demo_answer_key(hw_num, lines=10):
+    rng = random.Random(hw_num)
+    return "\n".join(f"{i}. {rng.choice(DEMO_ANSWERS)}" for i in range(1, lines + 1))
+
+def demo_spreadsheets(registration_key, groups_key, groups=4, students_per_group=25, homeworks=5):
+    """
+    A registration sheet plus a groups spreadsheet (Top List + "G#N" tabs)
+    with `students_per_group` registered students per group and deadlines and
+    answer keys set for the first `homeworks` homeworks.
+    """
+    registration = [list(REGISTRATION_HEADERS)]
+    top_list = [["", ""], ["", "Group Number", "Score"]]
+    tabs = {"Top List": top_list}
+    number = 0
+    for group in range(1, groups + 1):
+        title = f"G#{group}"
+        top_list.append(["", title, "0"])
+        header = ["", "Name", "", "Total"] + [""] * 30
+        hw_headers = ["", "", "", ""] + [str(hw) for hw in range(1, 31)]
+        deadlines = ["", "", "", ""] + ["2099.12.31, 23:59"] * homeworks + [""] * (30 - homeworks)
+        answers = ["", "", "", ""] + [demo_answer_key(hw) for hw in range(1, homeworks + 1)] + [""] * (30 - homeworks)
+        rows = [header, [""] * 34, hw_headers, deadlines, answers]
+        for _ in range(students_per_group):
+            number += 1
+            unique_id, telegram_id, name = demo_student(number)
+            registration.append([
+                name, "+998900000000", "N/A", f"@student{number}", "01/01/2000", "20-29",
+                "Tashkent", "Active", "6", "Friend", unique_id, str(telegram_id),
+                "01/01/2025 10:00", str(group),
+            ])
+            rows.append([unique_id, name, "", "0"] + [""] * 30)
+        tabs[title] = rows
+    return {registration_key: {"Sheet1": registration}, groups_key: tabs}
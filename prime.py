@@ -1,18 +1,33 @@
 import logging
 import gspread
+import hashlib
+import html
 import json
+import math
+import os
+import random
+import sys
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.dispatcher.router import Router
 import asyncio
+import bisect
+import difflib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pytz
 import re
+import sqlite3
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
 
 ################################################################################
 # 1) Admins & (Optional) Teachers
@@ -34,6 +49,19 @@ def is_teacher(user_id: int) -> bool:
 # 2) Text Parsing & Similarity Utilities
 ################################################################################
 
+# Everything except Latin letters and whitespace is dropped (numbering, punctuation, Cyrillic, ...)
+_NON_LETTERS_RE = re.compile(r"[^a-zA-Z\s]+")
+# ASCII fast path: one bytes.translate() call lowercases and deletes in C
+_ASCII_KEEP = {c for c in range(128) if chr(c).isalpha() or chr(c).isspace()}
+_ASCII_DELETE = bytes(c for c in range(256) if c not in _ASCII_KEEP)
+_ASCII_LOWER = bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", b"abcdefghijklmnopqrstuvwxyz")
+
+def _letters_lower(raw_text: str) -> str:
+    """Drop everything but a-z/A-Z and whitespace, then lowercase."""
+    if raw_text.isascii():
+        return raw_text.encode("ascii").translate(_ASCII_LOWER, _ASCII_DELETE).decode("ascii")
+    return _NON_LETTERS_RE.sub("", raw_text).lower()
+
 def parse_text(raw_text: str) -> str:
     """
     Remove punctuation/numbers, convert to lowercase, and return a space-separated string.
@@ -41,22 +69,26 @@ def parse_text(raw_text: str) -> str:
         Input:  "1. a\n2. b\n3. Word, test!"
         Output: "a b word test"
     """
-    # 1) Remove punctuation except whitespace/letters
-    only_letters = re.sub(r"[^a-zA-Z\s]+", "", raw_text)
+    # Numbering needs no separate pass: digits and "." / "-" / ")" are already removed
+    lines = _letters_lower(raw_text).split("\n")
+    return " ".join(filter(None, map(str.strip, lines)))
 
-    # 2) Convert to lowercase
-    lower_text = only_letters.lower()
+def parse_tokens(raw_text: str) -> tuple:
+    """
+    Same tokens as parse_text(raw_text).split(), without building the joined string.
+    Example:
+        Input:  "1. a\n2. b\n3. Word, test!"
+        Output: ("a", "b", "word", "test")
+    """
+    return tuple(_letters_lower(raw_text).split())
 
-    # 3) Remove numeric prefixes line by line
-    lines = lower_text.split("\n")
-    cleaned_lines = []
-    for line in lines:
-        line = re.sub(r"^\d+(\.|-|\))?\s*", "", line.strip())
-        if line:
-            cleaned_lines.append(line)
+# Leading item number of an answer line: "3. c", "3) c", "3-c", " 3: c"
+_LINE_LABEL_RE = re.compile(r"^\s*(\d+)\s*[.):\-]?")
 
-    # 4) Return space-joined
-    return " ".join(cleaned_lines)
+def line_label(raw_line: str):
+    """Item number an answer line starts with, or None if it isn't numbered."""
+    match = _LINE_LABEL_RE.match(raw_line)
+    return int(match.group(1)) if match else None
 
 def calculate_similarity(student_text: str, teacher_text: str) -> float:
     """
@@ -71,77 +103,1731 @@ def calculate_similarity(student_text: str, teacher_text: str) -> float:
     similarity = len(overlap) / len(teacher_tokens)
     return similarity
 
+def submitted_on_time(deadline_text: str, submitted_at: datetime) -> bool:
+    """
+    True if the homework came in on/before the deadline.
+    If no deadline is set (or it can't be parsed), it counts as on time.
+    """
+    if deadline_text.strip():
+        try:
+            deadline_dt = datetime.strptime(deadline_text.strip(), "%Y.%m.%d, %H:%M")
+            deadline_dt = pytz.timezone("Asia/Tashkent").localize(deadline_dt)
+            return submitted_at <= deadline_dt
+        except Exception as e:
+            logging.error(f"Error parsing deadline: {e}")
+    return True
+
+# Optional item weight at the end of an answer-key line: "3. colour | color [2]"
+_ITEM_WEIGHT_RE = re.compile(r"\[(\d+(?:\.\d+)?)\]\s*$")
+# Item number in front of an answer line, with its separator: "3. ", "3) ", "3 "
+_ITEM_NUMBER_RE = re.compile(r"^\s*\d+\s*(?:[.):\-]|\s)\s*")
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9\s]+")
+
+def parse_item_answer(raw_line: str) -> str:
+    """
+    One answer line normalized for per-item grading: parse_text() if it has
+    letters; answers made only of numbers keep their digits, without the item number.
+    Example:
+        Input:  "1. 1,990"
+        Output: "1990"
+    """
+    parsed = parse_text(raw_line)
+    if parsed or not any(char.isdigit() for char in raw_line):
+        return parsed
+    return _parse_number_answer(_ITEM_NUMBER_RE.sub("", raw_line, count=1))
+
+def _parse_number_answer(raw_answer: str) -> str:
+    return " ".join(_NON_ALNUM_RE.sub("", raw_answer.lower()).split())
+
+def parse_answer_item(raw_line: str):
+    """
+    Accepted answers and weight of one answer-key line.
+    Alternatives are separated by "|", the weight defaults to 1.
+    Example:
+        Input:  "3. Colour | color [2]"
+        Output: (("colour", "color"), 2.0)
+    """
+    weight = 1.0
+    match = _ITEM_WEIGHT_RE.search(raw_line)
+    if match:
+        weight = float(match.group(1))
+        raw_line = raw_line[:match.start()]
+    # Only the line's first answer carries the item number
+    alternatives = _ITEM_NUMBER_RE.sub("", raw_line, count=1).split("|")
+    answers = (parse_text(alternative) or _parse_number_answer(alternative) for alternative in alternatives)
+    return tuple(dict.fromkeys(filter(None, answers))), weight
+
+# Fuzzy matching: a student word within this many edits of a key word counts
+# as that word ("leters" -> "letters", 1 edit; "recieve" -> "receive", 2 edits);
+# 0 turns fuzzy matching off
+FUZZY_MAX_DISTANCE = 0
+# Shorter key words must match exactly, so "a" vs "b" answers stay distinct
+FUZZY_MIN_WORD_LENGTH = 5
+
+def levenshtein(a: str, b: str) -> int:
+    """Edit distance (insertions, deletions, substitutions) between two strings."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+class BKTree:
+    """
+    Words arranged by edit distance (a Burkhard-Keller tree).
+    search() finds every word within k edits of a query while skipping the
+    subtrees the triangle inequality rules out, instead of comparing against
+    every word.
+    """
+
+    def __init__(self, words=()):
+        # Each node is (word, {distance to parent: child node})
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                return
+            node = child
+
+    def search(self, word: str, max_distance: int):
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_word, children = stack.pop()
+            distance = levenshtein(word, node_word)
+            if distance <= max_distance:
+                found.append(node_word)
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+class CompiledAnswerKey:
+    """
+    A teacher's answer key parsed once: the raw text, its parsed form and
+    token set (for the similarity check) and the parsed form and item number
+    of every line (for aligning a student's lines in the line-by-line report).
+    Only the first of an item's "|" alternatives is in the token set; a
+    student who writes one of the others gets its words instead.
+    """
+
+    def __init__(self, raw_text: str):
+        self.raw = raw_text
+        self.lines = raw_text.splitlines()
+        first_answers = []
+        # (first answer's tokens, (tokens of each other answer, ...)) for lines with alternatives
+        self.alternative_tokens = []
+        for line in self.lines:
+            first, *others = line.split("|")
+            first_answers.append(first)
+            first_tokens = frozenset(parse_tokens(first))
+            other_tokens = tuple(filter(None, (frozenset(parse_tokens(other)) for other in others)))
+            if first_tokens and other_tokens:
+                self.alternative_tokens.append((first_tokens, other_tokens))
+        self.parsed = parse_text("\n".join(first_answers))
+        self.tokens = frozenset(self.parsed.split())
+        self.parsed_lines = [parse_text(line) for line in self.lines]
+        self.labels = [line_label(line) for line in self.lines]
+        items = [parse_answer_item(line) for line in self.lines]
+        self.answers = [answers for answers, _ in items]
+        self.weights = [weight for _, weight in items]
+        # Non-blank lines are the items a student is graded on
+        self.items = [i for i, line in enumerate(self.lines) if line.strip()]
+        item_labels = [self.labels[i] for i in self.items]
+        # Labels are only trusted when every item has its own, distinct number
+        self.labeled = bool(item_labels) and None not in item_labels and len(set(item_labels)) == len(item_labels)
+        # Built on first fuzzy lookup; student words repeat a lot, so results are kept
+        self._fuzzy_tree = None
+        self._fuzzy_matches = {}
+
+    def fuzzy_matches(self, token: str, max_distance: int) -> frozenset:
+        """Key words (of at least FUZZY_MIN_WORD_LENGTH letters) within max_distance edits of token."""
+        cache_key = (token, max_distance)
+        matches = self._fuzzy_matches.get(cache_key)
+        if matches is None:
+            if self._fuzzy_tree is None:
+                self._fuzzy_tree = BKTree(sorted(t for t in self.tokens if len(t) >= FUZZY_MIN_WORD_LENGTH))
+            matches = frozenset(self._fuzzy_tree.search(token, max_distance))
+            if len(self._fuzzy_matches) >= 10000:
+                self._fuzzy_matches.clear()
+            self._fuzzy_matches[cache_key] = matches
+        return matches
+
+    def similarity(self, student_tokens, max_distance=None) -> float:
+        """
+        Same result as calculate_similarity(parse_text(student_raw), self.parsed)
+        when fuzzy matching is off and the key has no alternatives; otherwise
+        near-miss words and other accepted answers count as well.
+        """
+        if not self.tokens:
+            return 0.0
+        if max_distance is None:
+            max_distance = FUZZY_MAX_DISTANCE
+        matched = self.tokens.intersection(student_tokens)
+        if max_distance > 0 and len(matched) < len(self.tokens):
+            matched = set(matched)
+            for token in set(student_tokens).difference(self.tokens):
+                matched.update(self.fuzzy_matches(token, max_distance))
+        if self.alternative_tokens and len(matched) < len(self.tokens):
+            matched = set(matched)
+            student_set = set(student_tokens)
+            for first_tokens, other_tokens in self.alternative_tokens:
+                if any(tokens <= student_set for tokens in other_tokens):
+                    matched.update(first_tokens)
+        return len(matched) / len(self.tokens)
+
+    def accepts(self, i: int, student_answer: str, max_distance=None) -> bool:
+        """
+        Whether a student line (parsed with parse_item_answer) is one of the
+        accepted answers of line i, or (with fuzzy matching on) within
+        max_distance edits of a long enough word answer.
+        """
+        if student_answer in self.answers[i]:
+            return True
+        if max_distance is None:
+            max_distance = FUZZY_MAX_DISTANCE
+        if max_distance <= 0 or not student_answer:
+            return False
+        return any(
+            len(answer) >= FUZZY_MIN_WORD_LENGTH
+            and not any(char.isdigit() for char in answer)
+            and abs(len(answer) - len(student_answer)) <= max_distance
+            and levenshtein(answer, student_answer) <= max_distance
+            for answer in self.answers[i]
+        )
+
+class AnswerKeyCache:
+    """
+    Compiled answer keys by (group tab, homework number).
+    Filled when a teacher saves a key, or on first use; a key whose raw text
+    changed in the sheet is recompiled.
+    """
+
+    def __init__(self):
+        self.keys = {}
+
+    def put(self, group_sheet_name, hw_num, raw_text):
+        answer_key = CompiledAnswerKey(raw_text)
+        self.keys[(group_sheet_name, hw_num)] = answer_key
+        return answer_key
+
+    def get(self, group_sheet_name, hw_num, raw_text):
+        answer_key = self.keys.get((group_sheet_name, hw_num))
+        if answer_key is None or answer_key.raw != raw_text:
+            answer_key = self.put(group_sheet_name, hw_num, raw_text)
+        return answer_key
+
+answer_keys = AnswerKeyCache()
+
+
+################################################################################
+# Persistent FSM Storage (SQLite)
+################################################################################
+
+FSM_DB_PATH = "fsm_states.sqlite3"
+FSM_STATE_TTL = 24 * 60 * 60   # conversations untouched for a day are dropped
+FSM_COMMIT_INTERVAL = 0.5      # seconds; writes made outside an update share one commit
+FSM_CACHE_TTL = 5              # seconds an unused clean record stays cached
+
+class SQLiteStorage(BaseStorage):
+    """
+    aiogram FSM storage in a SQLite database (WAL mode), so registration,
+    /edit, homework and deadline conversations survive restarts and several
+    bot processes can share one database file.
+    Reads go through an in-memory cache that is checked against the row's
+    updated_at, so a change made by another process is seen on the next
+    read. Writes update the cache immediately; FSMCommitMiddleware commits
+    them as one transaction before an update's handling finishes (anything
+    else within FSM_COMMIT_INTERVAL).
+    """
+
+    def __init__(self, path, state_ttl, commit_interval, cache_ttl):
+        self.state_ttl = state_ttl
+        self.commit_interval = commit_interval
+        self.cache_ttl = cache_ttl
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at)")
+        self._cache = {}     # key -> [state, data, updated_at, cached_at]
+        self._dirty = set()
+        self._commit_handle = None
+        self._last_purge = 0.0
+
+    @staticmethod
+    def _key(key):
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, "business_connection_id", None), key.destiny,
+        ))
+
+    def _record(self, key):
+        now = time.time()
+        record = self._cache.get(key)
+        if record is not None and key in self._dirty:
+            return record
+        # updated_at is None for a key with no row; a different value means another process wrote it
+        row = self.conn.execute("SELECT updated_at FROM fsm WHERE key = ?", (key,)).fetchone()
+        updated_at = row[0] if row else None
+        if record is None or record[2] != updated_at:
+            row = self.conn.execute(
+                "SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                record = [None, {}, None, now]
+            elif now - row[2] > self.state_ttl:
+                record = [None, {}, row[2], now]
+            else:
+                record = [row[0], json.loads(row[1]), row[2], now]
+            self._cache[key] = record
+        record[3] = now
+        return record
+
+    def _touch(self, key, record):
+        record[2] = record[3] = time.time()
+        self._dirty.add(key)
+        if self._commit_handle is None:
+            loop = asyncio.get_running_loop()
+            self._commit_handle = loop.call_later(self.commit_interval, self.commit)
+
+    def commit(self):
+        """Write all dirty records in one transaction and drop expired ones."""
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        now = time.time()
+        upserts, deletes = [], []
+        for key in self._dirty:
+            state, data, updated_at, _ = self._cache[key]
+            if state is None and not data:
+                deletes.append((key,))
+            else:
+                upserts.append((key, state, json.dumps(data), updated_at))
+        try:
+            self.conn.execute("BEGIN")
+            if upserts:
+                self.conn.executemany(
+                    "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+                    "data = excluded.data, updated_at = excluded.updated_at",
+                    upserts,
+                )
+            if deletes:
+                self.conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+            if now - self._last_purge > 60:
+                self.conn.execute("DELETE FROM fsm WHERE updated_at < ?", (now - self.state_ttl,))
+                self._last_purge = now
+            self.conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            logging.error(f"Error committing FSM states: {e}")
+            return
+        self._dirty.clear()
+        # Forget clean records nobody has read recently
+        for key in [k for k, record in self._cache.items() if now - record[3] > self.cache_ttl]:
+            del self._cache[key]
+
+    def commit_pending(self):
+        if self._dirty:
+            self.commit()
+
+    async def set_state(self, key, state=None):
+        key = self._key(key)
+        record = self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key):
+        return self._record(self._key(key))[0]
+
+    async def set_data(self, key, data):
+        key = self._key(key)
+        record = self._record(key)
+        record[1] = dict(data)
+        self._touch(key, record)
+
+    async def get_data(self, key):
+        return dict(self._record(self._key(key))[1])
+
+    def state_counts(self):
+        """{state: number of conversations in it}, for monitoring."""
+        self.commit()
+        rows = self.conn.execute(
+            "SELECT state, COUNT(*) FROM fsm WHERE state IS NOT NULL AND updated_at >= ? GROUP BY state",
+            (time.time() - self.state_ttl,),
+        )
+        return dict(rows.fetchall())
+
+    async def close(self):
+        if self.conn is None:
+            return
+        self.commit()
+        self.conn.close()
+        self.conn = None
+
+class FSMCommitMiddleware(BaseMiddleware):
+    """Commits the FSM writes an update made before the next one can be routed, by any process."""
+
+    def __init__(self, storage: SQLiteStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            self.storage.commit_pending()
+
 
 ################################################################################
 # 3) Bot & Google Sheets Initialization
 ################################################################################
 
-# Replace with your actual bot token (or load via environment variables)
-BOT_TOKEN = "REPLACE_BOT_TOKEN"
+# Replace with your actual bot token (or set the BOT_TOKEN environment variable)
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "REPLACE_BOT_TOKEN")
 
-# Replace with your actual scope
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+# "google" talks to Google Sheets; "fake" uses the in-memory stand-in from
+# fake_sheets.py (no network or google.json; see that module for latency/error knobs)
+SHEETS_BACKEND = os.environ.get("SHEETS_BACKEND", "google")
 
-# Replace with the path to your Google service-account JSON, or use an environment variable
-creds = ServiceAccountCredentials.from_json_keyfile_name(
-    "google.json",  # <--- replaced filename here
-    scope
-)
-client = gspread.authorize(creds)
+# Replace with your actual Google Sheet IDs
+REGISTRATION_SHEET_KEY = "REPLACE_SHEET_ID"
+GROUP_SHEETS_KEY = "REPLACE_SHEET2_ID"
+
+# gspread sets no HTTP timeout of its own; without one a hung request holds a Sheets worker forever
+SHEETS_HTTP_TIMEOUT = 90  # seconds
+
+if SHEETS_BACKEND == "fake":
+    import fake_sheets
+    client = fake_sheets.FakeClient.from_env(REGISTRATION_SHEET_KEY, GROUP_SHEETS_KEY)
+else:
+    # Replace with your actual scope
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+    # Replace with the path to your Google service-account JSON, or use an environment variable
+    creds = ServiceAccountCredentials.from_json_keyfile_name(
+        "google.json",  # <--- replaced filename here
+        scope
+    )
+    client = gspread.authorize(creds)
+    client.set_timeout(SHEETS_HTTP_TIMEOUT)
 
 # Registration sheet
-# Replace with your actual Google Sheet ID
-sheet = client.open_by_key("REPLACE_SHEET_ID").sheet1
+sheet = client.open_by_key(REGISTRATION_SHEET_KEY).sheet1
 
-# Another sheet (for top list or other data)
-sheet2 = client.open_by_key("REPLACE_SHEET2_ID").sheet1
+# Another sheet (for top list or other data); its "G#N" tabs hold the group homework grades
+sheet2 = client.open_by_key(GROUP_SHEETS_KEY).sheet1
+# Only "G#N" tabs are group sheets
+GROUP_TAB_RE = re.compile(r"G#\d+")
 
 # Replace with your group chat ID
 GROUP_CHAT_ID = -999999999
 
 logging.basicConfig(level=logging.INFO)
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+storage = SQLiteStorage(FSM_DB_PATH, FSM_STATE_TTL, FSM_COMMIT_INTERVAL, FSM_CACHE_TTL)
 dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(FSMCommitMiddleware(storage))
 router = Router()
 
+# Long-running helpers started by on_startup() (kept here so they are not garbage-collected)
+background_tasks = []
+
+
 ################################################################################
-# Generate line-by-line correctness report
+# Metrics (Prometheus text format on a local HTTP endpoint)
 ################################################################################
-def generate_line_by_line_report(teacher_raw: str, student_raw: str) -> str:
+
+# Scrape http://127.0.0.1:METRICS_PORT/metrics; set METRICS_PORT=0 to turn the endpoint off
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _metric_labels(label_names, label_values):
+    if not label_names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in label_values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(label_names, escaped)) + "}"
+
+class Histogram:
+    """Latency histogram per label set; observe() is O(log buckets)."""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket..., +Inf count, total count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, seconds):
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2) + [0.0]
+            series[bisect.bisect_left(self.buckets, seconds)] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = [(labels, list(series)) for labels, series in self.series.items()]
+        for label_values, series in series_items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                labels = _metric_labels(self.label_names + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _metric_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_count{labels} {series[-2]}")
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+        return lines
+
+class MetricsRegistry:
     """
-    Compare teacher's lines vs student's lines one-by-one.
-    Return a string showing which line is correct (✅) or wrong (❌).
+    Histograms recorded as events happen, plus gauges collected at scrape time
+    from the objects that already keep the numbers (queues, FSM storage, ...).
     """
-    teacher_lines = teacher_raw.splitlines()
-    student_lines = student_raw.splitlines()
 
-    max_len = max(len(teacher_lines), len(student_lines))
-    report_lines = []
+    def __init__(self):
+        self.histograms = []
+        self.gauges = []  # (name, help, label names, collect() -> {label values: value}, type)
+
+    def histogram(self, name, help_text, label_names=()):
+        histogram = Histogram(name, help_text, tuple(label_names))
+        self.histograms.append(histogram)
+        return histogram
+
+    def gauge(self, name, help_text, collect, label_names=(), kind="gauge"):
+        """kind="counter" for totals that only grow (counted elsewhere, read here)."""
+        self.gauges.append((name, help_text, tuple(label_names), collect, kind))
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self.histograms:
+            lines += histogram.render()
+        for name, help_text, label_names, collect, kind in self.gauges:
+            try:
+                values = collect()
+            except Exception as e:
+                logging.error(f"Error collecting metric {name}: {e}")
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for label_values, value in values.items():
+                lines.append(f"{name}{_metric_labels(label_names, label_values)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram(
+    "bot_handler_seconds", "Time spent handling a message, by handler.", ("handler", "outcome"))
+sheets_call_seconds = metrics.histogram(
+    "sheets_call_seconds", "Google Sheets call latency including thread-pool queueing.",
+    ("method", "worksheet", "outcome"))
+telegram_request_seconds = metrics.histogram(
+    "telegram_request_seconds", "Telegram Bot API request latency, by method.", ("method", "outcome"))
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Inner message middleware: times every handler that matched an update."""
+
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            handler_seconds.observe((name, outcome), time.perf_counter() - started)
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Bot session middleware: times every Bot API request (sends, edits, ...)."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            outcome = "retry_after"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            telegram_request_seconds.observe((type(method).__name__, outcome), time.perf_counter() - started)
+
+class MetricsServer:
+    """Minimal HTTP server answering GET /metrics with metrics.render()."""
+
+    def __init__(self, registry, host, port):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(self._handle, self.host, self.port)
+            logging.info(f"Metrics available at http://{self.host}:{self.port}/metrics")
+        except OSError as e:
+            logging.error(f"Could not start the metrics endpoint on {self.host}:{self.port}: {e}")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Skip the request headers
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+                status = "200 OK"
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+                body = self.registry.render().encode("utf-8")
+            else:
+                status = "404 Not Found"
+                content_type = "text/plain; charset=utf-8"
+                body = b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logging.warning(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
 
-    for i in range(max_len):
-        # Teacher line (raw) or blank if missing
-        t_line_raw = teacher_lines[i] if i < len(teacher_lines) else ""
-        # Student line (raw) or blank if missing
-        s_line_raw = student_lines[i] if i < len(student_lines) else ""
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
 
-        # For matching, parse them
-        t_line_parsed = parse_text(t_line_raw)
-        s_line_parsed = parse_text(s_line_raw)
+metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT)
 
-        # If parsed lines match exactly (non-empty), consider correct
-        is_correct = (t_line_parsed == s_line_parsed and t_line_parsed.strip() != "")
 
-        line_number_label = f"{i+1}."
+################################################################################
+# Sheets Gateway (blocking gspread calls run in a bounded thread pool)
+################################################################################
+
+# gspread is synchronous; calling it straight from a handler blocks the whole dispatcher
+SHEETS_MAX_WORKERS = 8
+SHEETS_CALL_TIMEOUT = 30  # seconds
+# Writes that would be applied twice if retried get longer to finish; when even that
+# runs out, the caller has to check whether the write landed before retrying
+SHEETS_NON_IDEMPOTENT_METHODS = {"append_row", "append_rows", "add_worksheet"}
+SHEETS_WRITE_TIMEOUT = 120  # seconds
+
+class SheetsGateway:
+    """
+    Runs gspread calls in a dedicated, size-limited thread pool so a slow
+    Sheets response only delays the handler waiting for it. Non-idempotent
+    writes get the longer write_timeout, since a retry would duplicate them.
+    Usage: `values = await sheets.call(ws.get_all_values)`
+    """
+
+    def __init__(self, max_workers, timeout, write_timeout):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self._lock = threading.Lock()
+        # Metrics
+        self.queued = 0       # submitted, waiting for a free worker
+        self.in_flight = 0    # currently running in a worker
+        self.max_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    async def call(self, func, *args, timeout=None, **kwargs):
+        started = time.perf_counter()
+        method = getattr(func, "__name__", "unknown")
+        if not timeout:
+            timeout = self.write_timeout if method in SHEETS_NON_IDEMPOTENT_METHODS else self.timeout
+        # Bound worksheet methods carry their tab; spreadsheet/client calls don't have one
+        owner = getattr(func, "__self__", None)
+        worksheet = owner.title if hasattr(owner, "update_cell") else ""
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.in_flight += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        concurrent_future = self.executor.submit(run)
+        future = asyncio.wrap_future(concurrent_future)
+
+        done, _ = await asyncio.wait([future], timeout=timeout)
+        if not done:
+            # A running thread can't be interrupted; only drop the call if it hasn't started yet
+            if concurrent_future.cancel():
+                with self._lock:
+                    self.queued -= 1
+            self.timed_out += 1
+            sheets_call_seconds.observe((method, worksheet, "timeout"), time.perf_counter() - started)
+            logging.error(f"Sheets call {method} timed out after {timeout}s (queued: {self.queued})")
+            raise TimeoutError(f"Google Sheets did not respond within {timeout} seconds")
+
+        try:
+            result = future.result()
+        except Exception:
+            self.failed += 1
+            sheets_call_seconds.observe((method, worksheet, "error"), time.perf_counter() - started)
+            raise
+        self.completed += 1
+        sheets_call_seconds.observe((method, worksheet, "ok"), time.perf_counter() - started)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+sheets = SheetsGateway(SHEETS_MAX_WORKERS, SHEETS_CALL_TIMEOUT, SHEETS_WRITE_TIMEOUT)
+
+
+################################################################################
+# Worksheet Registry (spreadsheet & tab handles opened once)
+################################################################################
+
+# Tab lists are re-fetched after this many seconds, or on a miss (new "G#N" tab)
+WORKSHEET_CACHE_TTL = 600
+# ...but a miss re-fetches at most this often, so a bad group number can't hammer the API
+WORKSHEET_MISS_REFRESH_INTERVAL = 30
+
+class WorksheetRegistry:
+    """
+    Opens each spreadsheet once and resolves tabs by title from a single
+    `worksheets()` metadata fetch, instead of `open_by_key(...).worksheet(...)`
+    on every request. Raises gspread's WorksheetNotFound like `.worksheet()`.
+    """
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+        self.spreadsheets = {}  # key -> Spreadsheet
+        self.worksheets = {}    # key -> {title: Worksheet}
+        self.fetched_at = {}    # key -> time.monotonic() of the last tab list fetch
+        self._locks = {}
+
+    async def _refresh(self, key):
+        spreadsheet = self.spreadsheets.get(key)
+        if spreadsheet is None:
+            spreadsheet = await sheets.call(self.client.open_by_key, key)
+            self.spreadsheets[key] = spreadsheet
+        worksheet_list = await sheets.call(spreadsheet.worksheets)
+        self.worksheets[key] = {ws.title: ws for ws in worksheet_list}
+        self.fetched_at[key] = time.monotonic()
+
+    async def _ensure_fresh(self, key, missing_title=None):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            age = time.monotonic() - self.fetched_at.get(key, float("-inf"))
+            if key not in self.worksheets or age > self.ttl:
+                await self._refresh(key)
+            elif missing_title and missing_title not in self.worksheets[key] \
+                    and age > WORKSHEET_MISS_REFRESH_INTERVAL:
+                await self._refresh(key)
+
+    async def get(self, key, title):
+        ws = self.worksheets.get(key, {}).get(title)
+        if ws is None or time.monotonic() - self.fetched_at[key] > self.ttl:
+            await self._ensure_fresh(key, missing_title=title)
+            ws = self.worksheets[key].get(title)
+        if ws is None:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return ws
+
+    async def titles(self, key):
+        await self._ensure_fresh(key)
+        return list(self.worksheets[key])
+
+    async def group_titles(self, key):
+        """The spreadsheet's "G#N" tabs, in group number order."""
+        return sorted((t for t in await self.titles(key) if GROUP_TAB_RE.fullmatch(t)), key=lambda t: int(t[2:]))
+
+    async def spreadsheet(self, key):
+        await self._ensure_fresh(key)
+        return self.spreadsheets[key]
+
+    def invalidate(self, key):
+        self.fetched_at.pop(key, None)
+        self.worksheets.pop(key, None)
+
+worksheets = WorksheetRegistry(client, WORKSHEET_CACHE_TTL)
+
+
+################################################################################
+# Grade Write Queue (write-behind batching for group sheets)
+################################################################################
+
+GRADE_FLUSH_INTERVAL = 2       # seconds between background flushes
+GRADE_FLUSH_THRESHOLD = 50     # pending cells that trigger an early flush
+GRADE_JOURNAL_PATH = "grade_journal.jsonl"
+
+class GradeWriteQueue:
+    """
+    Collects grade cells per worksheet and writes them with one `batch_update`
+    per worksheet, every GRADE_FLUSH_INTERVAL seconds or as soon as
+    GRADE_FLUSH_THRESHOLD cells are pending.
+    Every grade is appended (and fsynced) to a local journal before it is
+    acknowledged; the journal is replayed on startup and compacted after each
+    flush, so a crash before a flush never loses a grade.
+    """
+
+    def __init__(self, journal_path, flush_interval, flush_threshold):
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.pending = {}  # (spreadsheet key, worksheet title) -> {(row, col): value}
+        self.inflight = {}  # the batch a running flush took out of `pending`, same layout
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        # Called with the set of worksheet titles after grades were written to them
+        self.listeners = []
+        # Metrics
+        self.cells_written = 0
+        self.batches_written = 0
+        self.failed_batches = 0
+
+    def pending_count(self):
+        return sum(len(cells) for cells in self.pending.values())
+
+    def unflushed(self, key, title):
+        """{(row, col): value} of one worksheet that may not be in the sheet yet; pending beats in-flight."""
+        cells = dict(self.inflight.get((key, title), {}))
+        cells.update(self.pending.get((key, title), {}))
+        return cells
+
+    def _add(self, key, title, row, col, value):
+        self.pending.setdefault((key, title), {})[(row, col)] = value
+
+    def replay_journal(self):
+        """Load grades that were acknowledged but not flushed before the last shutdown."""
+        if not os.path.exists(self.journal_path):
+            return 0
+        replayed = 0
+        with open(self.journal_path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                    self._add(entry["key"], entry["ws"], entry["row"], entry["col"], entry["value"])
+                    replayed += 1
+                except (ValueError, KeyError):
+                    # A torn last line from a crash mid-write; it was never acknowledged
+                    logging.warning(f"Skipping unreadable grade journal line: {line!r}")
+        # Rewrite the journal cleanly so new entries don't land after a torn line
+        self._compact_journal()
+        if replayed:
+            logging.info(f"Replayed {replayed} unflushed grade(s) from {self.journal_path}")
+        return replayed
+
+    def enqueue(self, key, title, row, col, value):
+        """Durably record a grade; it reaches the sheet on the next flush."""
+        entry = {"key": key, "ws": title, "row": row, "col": col, "value": str(value)}
+        with open(self.journal_path, "a", encoding="utf-8") as journal:
+            journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._add(key, title, row, col, str(value))
+        if self.pending_count() >= self.flush_threshold:
+            self._wake.set()
+
+    def _compact_journal(self):
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as journal:
+            for (key, title), cells in self.pending.items():
+                for (row, col), value in cells.items():
+                    entry = {"key": key, "ws": title, "row": row, "col": col, "value": value}
+                    journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch, self.pending = self.pending, {}
+            self.inflight = batch
+            written = set()
+            try:
+                for (key, title), cells in batch.items():
+                    data = [
+                        {"range": rowcol_to_a1(row, col), "values": [[value]]}
+                        for (row, col), value in cells.items()
+                    ]
+                    try:
+                        ws = await worksheets.get(key, title)
+                        await sheets.call(ws.batch_update, data, value_input_option="USER_ENTERED")
+                        self.cells_written += len(data)
+                        self.batches_written += 1
+                        written.add(title)
+                    except Exception as e:
+                        logging.error(f"Error flushing {len(data)} grade(s) to {title}: {e}")
+                        self.failed_batches += 1
+                        # Retry on the next flush, unless a newer grade was queued for the same cell
+                        retry = self.pending.setdefault((key, title), {})
+                        for cell, value in cells.items():
+                            retry.setdefault(cell, value)
+            finally:
+                self.inflight = {}
+            self._compact_journal()
+        if written:
+            for listener in self.listeners:
+                try:
+                    listener(written)
+                except Exception as e:
+                    logging.error(f"Error notifying grade listener: {e}")
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self.pending:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logging.error(f"Error in grade write queue: {e}")
+
+    def stats(self):
+        return {
+            "pending": self.pending_count(),
+            "cells_written": self.cells_written,
+            "batches_written": self.batches_written,
+            "failed_batches": self.failed_batches,
+        }
+
+grade_queue = GradeWriteQueue(GRADE_JOURNAL_PATH, GRADE_FLUSH_INTERVAL, GRADE_FLUSH_THRESHOLD)
+
+
+################################################################################
+# Group Sheet Snapshots (in-memory copies of the "G#N" tabs)
+################################################################################
+
+# Snapshots are re-downloaded after this many seconds to pick up edits made directly in the sheet
+GROUP_SNAPSHOT_TTL = 120
+
+class GroupSnapshot:
+    """
+    One "G#N" tab held in memory:
+      row 3 => HW headers ("1", "2", ... "30")
+      row 4 => deadlines
+      row 5 => teacher answers
+      row 6+ => students, indexed by Unique ID (column A)
+    All row/col arguments are 1-based, like gspread.
+    """
+
+    def __init__(self, values):
+        self.complete = len(values) >= 5
+        self.headers = values[2] if len(values) > 2 else []
+        self.deadlines = values[3] if len(values) > 3 else []
+        self.answers = values[4] if len(values) > 4 else []
+        self.hw_columns = {}     # "15" -> 0-based column index (first match, like list.index)
+        for idx, header in reversed(list(enumerate(self.headers))):
+            self.hw_columns[header] = idx
+        self.rows = {}           # row number -> list of cell values
+        self.by_unique_id = {}   # "V3001" -> row number
+        for row_number, row in enumerate(values[5:], start=6):
+            self.rows[row_number] = row
+            if row and row[0].strip():
+                self.by_unique_id.setdefault(row[0].strip(), row_number)
+        self.loaded_at = time.monotonic()
+
+    def _row(self, row_number):
+        if row_number == 3:
+            return self.headers
+        if row_number == 4:
+            return self.deadlines
+        if row_number == 5:
+            return self.answers
+        return self.rows.get(row_number)
+
+    def cell(self, row_number, col_index):
+        row = self._row(row_number) or []
+        return row[col_index - 1] if col_index - 1 < len(row) else ""
+
+    def set_cell(self, row_number, col_index, value):
+        row = self._row(row_number)
+        if row is None:
+            return
+        if len(row) < col_index:
+            row.extend([""] * (col_index - len(row)))
+        row[col_index - 1] = str(value)
+
+    def find_student(self, unique_id):
+        row_number = self.by_unique_id.get(str(unique_id).strip())
+        if row_number is None:
+            return None, None
+        return row_number, self.rows[row_number]
+
+    def hw_column(self, hw_num):
+        """0-based column index of homework #hw_num, or None."""
+        return self.hw_columns.get(str(hw_num))
+
+class GroupSnapshotCache:
+    """
+    Serves "G#N" tabs from memory. The bot's own writes (grades, deadlines,
+    answer keys) patch the cached cells in place; anything else is picked up
+    when the snapshot expires after GROUP_SNAPSHOT_TTL.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.snapshots = {}  # worksheet title -> GroupSnapshot
+        self._locks = {}
+        # Called with (title, snapshot) whenever a tab is (re)loaded from the sheet
+        self.listeners = []
+
+    def _expired(self, snapshot):
+        return snapshot is None or time.monotonic() - snapshot.loaded_at > self.ttl
+
+    async def get(self, title):
+        snapshot = self.snapshots.get(title)
+        if not self._expired(snapshot):
+            return snapshot
+        lock = self._locks.setdefault(title, asyncio.Lock())
+        async with lock:
+            snapshot = self.snapshots.get(title)
+            if self._expired(snapshot):
+                ws = await worksheets.get(GROUP_SHEETS_KEY, title)
+                # Grades queued or being flushed aren't in the sheet yet. A flush can also finish
+                # while the download runs, so take the cells from both before and after it.
+                unflushed = grade_queue.unflushed(GROUP_SHEETS_KEY, title)
+                snapshot = GroupSnapshot(await sheets.call(ws.get_all_values))
+                unflushed.update(grade_queue.unflushed(GROUP_SHEETS_KEY, title))
+                for (row, col), value in unflushed.items():
+                    snapshot.set_cell(row, col, value)
+                self.snapshots[title] = snapshot
+                for listener in self.listeners:
+                    try:
+                        listener(title, snapshot)
+                    except Exception as e:
+                        logging.error(f"Error notifying snapshot listener for {title}: {e}")
+        return snapshot
+
+    def set_cell(self, title, row_number, col_index, value):
+        snapshot = self.snapshots.get(title)
+        if snapshot is not None:
+            snapshot.set_cell(row_number, col_index, value)
+
+    def invalidate(self, title=None):
+        if title is None:
+            self.snapshots.clear()
+        else:
+            self.snapshots.pop(title, None)
+
+group_cache = GroupSnapshotCache(GROUP_SNAPSHOT_TTL)
+
+
+################################################################################
+# Submission Archive (students' raw answers, kept locally)
+################################################################################
+
+SUBMISSIONS_DB_PATH = "submissions.sqlite3"
+
+class SubmissionArchive:
+    """
+    Append-only store of every homework submission attempt: raw text,
+    normalized tokens, the answer key it was graded against, similarity and
+    score (None if it was rejected). The sheet only keeps "15"/"10", so this
+    is what regrades, plagiarism checks and analytics read.
+    Indexed for per-student and per-homework queries.
+    `conn` belongs to the event loop thread; worker threads read through
+    their own `reader()` connection (WAL lets it run alongside writes).
+    """
+
+    COLUMNS = ("id", "unique_id", "group_name", "homework", "raw_text", "tokens",
+               "answer_key", "similarity", "score", "submitted_at")
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS answer_keys (id INTEGER PRIMARY KEY AUTOINCREMENT, raw_text TEXT NOT NULL UNIQUE)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS submissions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, unique_id TEXT NOT NULL, group_name TEXT NOT NULL, "
+            "homework INTEGER NOT NULL, raw_text TEXT NOT NULL, tokens TEXT NOT NULL, "
+            "answer_key_id INTEGER REFERENCES answer_keys (id), similarity REAL, score TEXT, "
+            "submitted_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS submissions_by_student ON submissions (unique_id, id)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS submissions_by_homework ON submissions (group_name, homework, id)"
+        )
+        self._answer_key_ids = {}  # raw key text -> answer_keys.id
+
+    def _answer_key_id(self, raw_text):
+        key_id = self._answer_key_ids.get(raw_text)
+        if key_id is None:
+            self.conn.execute("INSERT OR IGNORE INTO answer_keys (raw_text) VALUES (?)", (raw_text,))
+            key_id = self.conn.execute(
+                "SELECT id FROM answer_keys WHERE raw_text = ?", (raw_text,)
+            ).fetchone()[0]
+            self._answer_key_ids[raw_text] = key_id
+        return key_id
+
+    def record(self, unique_id, group_name, homework, raw_text, tokens, answer_key_raw,
+               similarity, score, submitted_at):
+        cursor = self.conn.execute(
+            "INSERT INTO submissions (unique_id, group_name, homework, raw_text, tokens, "
+            "answer_key_id, similarity, score, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (unique_id, group_name, homework, raw_text, " ".join(tokens),
+             self._answer_key_id(answer_key_raw), similarity, score, submitted_at.timestamp()),
+        )
+        return cursor.lastrowid
+
+    def reader(self):
+        """A new read-only connection, for queries made off the event loop thread."""
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+
+    def _query(self, where, params, limit=None, conn=None):
+        sql = (
+            "SELECT s.id, s.unique_id, s.group_name, s.homework, s.raw_text, s.tokens, "
+            "k.raw_text, s.similarity, s.score, s.submitted_at "
+            "FROM submissions s LEFT JOIN answer_keys k ON k.id = s.answer_key_id "
+            f"WHERE {where} ORDER BY s.id {'DESC LIMIT ?' if limit else 'ASC'}"
+        )
+        rows = (conn or self.conn).execute(sql, params + (limit,) if limit else params).fetchall()
+        if limit:
+            rows.reverse()
+        tz_tashkent = pytz.timezone("Asia/Tashkent")
+        submissions = []
+        for row in rows:
+            submission = dict(zip(self.COLUMNS, row))
+            submission["tokens"] = tuple(submission["tokens"].split())
+            submission["submitted_at"] = datetime.fromtimestamp(submission["submitted_at"], tz_tashkent)
+            submissions.append(submission)
+        return submissions
+
+    def for_student(self, unique_id, limit=None):
+        """A student's attempts, oldest first (the last `limit` only, if given)."""
+        return self._query("s.unique_id = ?", (unique_id,), limit)
+
+    def for_homework(self, group_name, homework, conn=None):
+        """Every attempt for one homework in one group, oldest first."""
+        return self._query("s.group_name = ? AND s.homework = ?", (group_name, homework), conn=conn)
+
+    def attempts_for_homework(self, group_name, homework):
+        """{unique_id: [submission, ...]} with each student's attempts, oldest first."""
+        attempts = {}
+        for submission in self.for_homework(group_name, homework):
+            attempts.setdefault(submission["unique_id"], []).append(submission)
+        return attempts
+
+    def close(self):
+        self.conn.close()
+
+archive = SubmissionArchive(SUBMISSIONS_DB_PATH)
+
+
+################################################################################
+# Plagiarism Detection (MinHash + LSH over accepted submissions' mistakes)
+################################################################################
+
+PLAGIARISM_NUM_PERM = 64            # MinHash signature length
+PLAGIARISM_BANDS = 16               # 16 bands x 4 rows: pairs above ~0.5 Jaccard become candidates
+PLAGIARISM_THRESHOLD = 0.8          # estimated Jaccard similarity that gets a pair flagged
+PLAGIARISM_MIN_WRONG_ITEMS = 3      # fewer shared mistakes than this happen by chance
+_MERSENNE_PRIME = (1 << 61) - 1
+
+def submission_shingles(alignment):
+    """
+    The submission's wrong answers keyed by item ("7:recieve"). Correct
+    answers are what every honest student shares, so only matching
+    mistakes say anything about copying. Missing items are left out.
+    """
+    shingles = set()
+    for i, j, is_correct in alignment.pairs:
+        if j is None or is_correct:
+            continue
+        answer = parse_item_answer(alignment.student_lines[j])
+        if answer:
+            shingles.add(f"{i}:{answer}")
+    return shingles
+
+class MinHasher:
+    """MinHash signatures from a fixed family of (a*x + b) mod p hash functions."""
+
+    def __init__(self, num_perm, seed=1):
+        rng = random.Random(seed)
+        self.params = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+
+    def signature(self, shingles):
+        # Stable across restarts, unlike hash(str)
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+                  for s in shingles]
+        return tuple(min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self.params)
+
+class LSHIndex:
+    """
+    Locality-sensitive hashing over MinHash signatures for one homework.
+    A lookup only touches the buckets the signature falls into, so checking
+    a new submission doesn't compare it with every earlier one.
+    """
+
+    def __init__(self, bands, rows):
+        self.bands = bands
+        self.rows = rows
+        self.buckets = [{} for _ in range(bands)]  # band -> {band values: {unique_id, ...}}
+        self.signatures = {}                        # unique_id -> signature
+
+    def _band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows] for i in range(self.bands)]
+
+    def remove(self, unique_id):
+        signature = self.signatures.pop(unique_id, None)
+        if signature is None:
+            return
+        for band, key in zip(self.buckets, self._band_keys(signature)):
+            band[key].discard(unique_id)
+
+    def insert(self, unique_id, signature):
+        # Only a student's latest accepted submission is indexed
+        self.remove(unique_id)
+        self.signatures[unique_id] = signature
+        for band, key in zip(self.buckets, self._band_keys(signature)):
+            band.setdefault(key, set()).add(unique_id)
+
+    def query(self, signature, exclude=None):
+        """[(unique_id, estimated Jaccard)] for candidates sharing at least one band, best first."""
+        candidates = set()
+        for band, key in zip(self.buckets, self._band_keys(signature)):
+            candidates.update(band.get(key, ()))
+        candidates.discard(exclude)
+        matches = []
+        for unique_id in candidates:
+            other = self.signatures[unique_id]
+            estimate = sum(x == y for x, y in zip(signature, other)) / len(signature)
+            matches.append((unique_id, estimate))
+        return sorted(matches, key=lambda match: match[1], reverse=True)
+
+class PlagiarismDetector:
+    """
+    Keeps one LSH index per (group tab, homework), built from the submission
+    archive on first use (and again when the answer key changes, since what
+    counts as a mistake does) and updated with every accepted submission.
+    """
+
+    def __init__(self, num_perm, bands, threshold):
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.indexes = {}
+        self._locks = {}
+
+    def _build_index(self, group_name, homework, answer_key):
+        index = LSHIndex(self.bands, self.rows)
+        # Runs in a worker thread, so it can't share archive.conn with the event loop's writes
+        conn = archive.reader()
+        try:
+            submissions = archive.for_homework(group_name, homework, conn=conn)
+        finally:
+            conn.close()
+        for submission in submissions:
+            if submission["score"] is None:
+                continue
+            shingles = submission_shingles(align_answers(answer_key, submission["raw_text"]))
+            if len(shingles) >= PLAGIARISM_MIN_WRONG_ITEMS:
+                index.insert(submission["unique_id"], self.hasher.signature(shingles))
+            else:
+                index.remove(submission["unique_id"])
+        return index
+
+    async def _index(self, group_name, homework, answer_key):
+        key = (group_name, homework)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            key_raw, index = self.indexes.get(key, (None, None))
+            if index is None or key_raw != answer_key.raw:
+                # Aligning and hashing a large backlog is CPU work; keep it off the event loop
+                index = await asyncio.to_thread(self._build_index, group_name, homework, answer_key)
+                self.indexes[key] = (answer_key.raw, index)
+        return index
+
+    async def check(self, unique_id, group_name, homework, alignment):
+        """
+        Add an accepted submission to its homework's index and return earlier
+        submissions by other students with the same mistakes: [(unique_id, similarity)].
+        Submissions with fewer than PLAGIARISM_MIN_WRONG_ITEMS mistakes aren't checked.
+        """
+        index = await self._index(group_name, homework, alignment.answer_key)
+        shingles = submission_shingles(alignment)
+        if len(shingles) < PLAGIARISM_MIN_WRONG_ITEMS:
+            index.remove(unique_id)
+            return []
+        signature = self.hasher.signature(shingles)
+        matches = index.query(signature, exclude=unique_id)
+        index.insert(unique_id, signature)
+        return [(other, estimate) for other, estimate in matches if estimate >= self.threshold]
+
+plagiarism = PlagiarismDetector(PLAGIARISM_NUM_PERM, PLAGIARISM_BANDS, PLAGIARISM_THRESHOLD)
+
+
+################################################################################
+# Roster Index (in-memory copy of the registration sheet)
+################################################################################
+
+# How often the roster is re-synced with the sheet (catches manual edits, e.g. GROUP NUMBER)
+ROSTER_REFRESH_INTERVAL = 60
+
+class RosterIndex:
+    """
+    Keeps the registration sheet in memory with dict indexes by Telegram ID,
+    Unique ID and row number, so lookups are O(1) and make no network calls.
+    The bot's own writes are applied locally; a periodic refresh re-indexes
+    only the rows that changed in the sheet since the last sync.
+    """
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.headers = []
+        self.columns = {}         # header -> 0-based column index
+        self.rows = {}            # row number -> list of cell values
+        self.by_telegram_id = {}  # "123456789" -> row number
+        self.by_unique_id = {}    # "V3001" -> row number
+        self.loaded = False
+        # Rows written by the bot, so a refresh that started earlier doesn't undo them
+        self._write_seq = 0
+        self._written_rows = {}
+
+    async def load(self):
+        since_seq = self._write_seq
+        self.apply_values(await sheets.call(self.worksheet.get_all_values), since_seq)
+        self.loaded = True
+
+    def apply_values(self, values, since_seq):
+        """
+        Merge a full `get_all_values()` download into the index.
+        Only rows that differ from the cached copy are re-indexed.
+        Returns the number of rows that changed.
+        """
+        headers = [header.strip() for header in values[0]] if values else []
+        if headers != self.headers:
+            self.headers = headers
+            self.columns = {header: idx for idx, header in reversed(list(enumerate(headers)))}
+            self.rows.clear()
+            self.by_telegram_id.clear()
+            self.by_unique_id.clear()
+
+        changed = 0
+        seen = set()
+        for row_number, row in enumerate(values[1:], start=2):
+            seen.add(row_number)
+            if self._written_rows.get(row_number, 0) > since_seq:
+                continue
+            row = self._normalize_row(row)
+            if self.rows.get(row_number) != row:
+                self._index_row(row_number, row)
+                changed += 1
+
+        for row_number in list(self.rows):
+            if row_number not in seen and self._written_rows.get(row_number, 0) <= since_seq:
+                self._unindex_row(row_number)
+                del self.rows[row_number]
+                changed += 1
+        return changed
+
+    async def refresh_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            since_seq = self._write_seq
+            try:
+                values = await sheets.call(self.worksheet.get_all_values)
+                changed = self.apply_values(values, since_seq)
+                if changed:
+                    logging.info(f"Roster refresh: {changed} row(s) changed")
+            except Exception as e:
+                logging.error(f"Error refreshing roster: {e}")
+
+    def column_index(self, column_name):
+        """0-based index of a header, or None if the column is missing."""
+        return self.columns.get(column_name)
+
+    def _normalize_row(self, row):
+        row = [str(value) for value in row]
+        if len(row) < len(self.headers):
+            row += [""] * (len(self.headers) - len(row))
+        return row
+
+    def _key(self, row, column_name):
+        idx = self.column_index(column_name)
+        if idx is None or idx >= len(row):
+            return ""
+        return str(row[idx]).strip()
+
+    def _unindex_row(self, row_number):
+        old_row = self.rows.get(row_number)
+        if old_row is None:
+            return
+        telegram_id = self._key(old_row, "Telegram ID")
+        if self.by_telegram_id.get(telegram_id) == row_number:
+            del self.by_telegram_id[telegram_id]
+        unique_id = self._key(old_row, "Unique ID")
+        if self.by_unique_id.get(unique_id) == row_number:
+            del self.by_unique_id[unique_id]
+
+    def _index_row(self, row_number, row):
+        self._unindex_row(row_number)
+        row = self._normalize_row(row)
+        self.rows[row_number] = row
+        telegram_id = self._key(row, "Telegram ID")
+        if telegram_id:
+            self.by_telegram_id[telegram_id] = row_number
+        unique_id = self._key(row, "Unique ID")
+        if unique_id:
+            self.by_unique_id[unique_id] = row_number
+
+    def _mark_written(self, row_number):
+        self._write_seq += 1
+        self._written_rows[row_number] = self._write_seq
+
+    # --- Local writes (call after the matching sheet write succeeded) ---
+
+    def add_row(self, row_number, values):
+        """`row_number` is where the sheet put the row; see appended_row_number()."""
+        self._mark_written(row_number)
+        self._index_row(row_number, values)
+        return row_number
+
+    def set_cell(self, row_number, col_index, value):
+        """`col_index` is 1-based, like gspread's update_cell."""
+        row = list(self.rows.get(row_number, []))
+        if len(row) < col_index:
+            row += [""] * (col_index - len(row))
+        row[col_index - 1] = str(value)
+        self._mark_written(row_number)
+        self._index_row(row_number, row)
+
+    # --- Lookups ---
+
+    def find_by_telegram_id(self, telegram_id):
+        row_number = self.by_telegram_id.get(str(telegram_id).strip())
+        if row_number is None:
+            return None, None
+        return row_number, self.rows[row_number]
+
+    def find_by_unique_id(self, unique_id):
+        row_number = self.by_unique_id.get(str(unique_id).strip())
+        if row_number is None:
+            return None, None
+        return row_number, self.rows[row_number]
+
+    def get_row(self, row_number):
+        return self.rows.get(row_number)
+
+    def get_value(self, row, column_name):
+        return self._key(row, column_name)
+
+    def record(self, row):
+        """Row as a {header: value} dict, similar to get_all_records()."""
+        return {header: self._key(row, header) for header in self.headers if header}
+
+    def telegram_ids(self):
+        ids = (self._key(self.rows[row_number], "Telegram ID") for row_number in sorted(self.rows))
+        return [telegram_id for telegram_id in ids if telegram_id]
+
+def appended_row_number(response):
+    """
+    Row an append_row() landed on, read from the response's updatedRange
+    ("Sheet1!A12:M12"). Concurrent appends and rows added by hand make it
+    unpredictable from the local copy. None if the response has no range.
+    """
+    updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+    first_cell = updated_range.rpartition("!")[2].split(":")[0]
+    try:
+        return a1_to_rowcol(first_cell)[0]
+    except gspread.exceptions.IncorrectCellLabel:
+        return None
+
+roster = RosterIndex(sheet)
+
+################################################################################
+# Line Alignment (student lines -> answer-key items)
+################################################################################
+
+ALIGN_DIFF_WINDOW = 200  # widest stretch between anchors handed to difflib; wider ones are paired in order
+
+def unique_line_anchors(a, b):
+    """
+    (x, y) positions of non-empty values that occur exactly once in both a
+    and b, reduced to the longest run that is in order in both (the
+    "patience diff" anchors). Found with a hash pass and an O(n log n)
+    longest increasing subsequence.
+    """
+    positions_a, positions_b = {}, {}
+    for x, value in enumerate(a):
+        positions_a.setdefault(value, []).append(x)
+    for y, value in enumerate(b):
+        positions_b.setdefault(value, []).append(y)
+    candidates = sorted((xs[0], positions_b[value][0]) for value, xs in positions_a.items()
+                        if value and len(xs) == 1 and len(positions_b.get(value, ())) == 1)
+    tails, tail_index, previous = [], [], []
+    for k, (_, y) in enumerate(candidates):
+        position = bisect.bisect_left(tails, y)
+        if position == len(tails):
+            tails.append(y)
+            tail_index.append(k)
+        else:
+            tails[position] = y
+            tail_index[position] = k
+        previous.append(tail_index[position - 1] if position else None)
+    chain = []
+    k = tail_index[-1] if tail_index else None
+    while k is not None:
+        chain.append(candidates[k])
+        k = previous[k]
+    return chain[::-1]
+
+def diff_opcodes(a, b):
+    """
+    SequenceMatcher-style opcodes for a -> b. Lines unique to both sides
+    anchor the diff; difflib (quadratic) only runs on the stretches between
+    anchors up to ALIGN_DIFF_WINDOW lines, so the total cost stays within
+    O(n * ALIGN_DIFF_WINDOW). Wider stretches come back as one "replace".
+    """
+    opcodes = []
+    x0 = y0 = 0
+    for x, y in unique_line_anchors(a, b) + [(len(a), len(b))]:
+        if x > x0 or y > y0:
+            if x - x0 <= ALIGN_DIFF_WINDOW and y - y0 <= ALIGN_DIFF_WINDOW:
+                matcher = difflib.SequenceMatcher(None, a[x0:x], b[y0:y], autojunk=False)
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                    opcodes.append((tag, x0 + i1, x0 + i2, y0 + j1, y0 + j2))
+            else:
+                opcodes.append(("replace", x0, x, y0, y))
+        if x < len(a):
+            opcodes.append(("equal", x, x + 1, y, y + 1))
+        x0, y0 = x + 1, y + 1
+    return opcodes
+
+class LineAlignment:
+    """
+    Result of matching a student's lines to the items of an answer key.
+    pairs: (key line index, student line index or None if missing, correct)
+    in answer-key order; extra: student line indexes matched to no item;
+    scores: points earned per item (its weight if correct, else 0).
+    Computed once per submission and shared by grading, the report and the summary.
+    """
+
+    def __init__(self, answer_key: CompiledAnswerKey, student_lines, pairs, extra):
+        self.answer_key = answer_key
+        self.student_lines = student_lines
+        self.pairs = pairs
+        self.extra = extra
+        self.scores = [answer_key.weights[i] if is_correct else 0.0 for i, _, is_correct in pairs]
+        self.earned = sum(self.scores)
+        self.possible = sum(answer_key.weights[i] for i, _, _ in pairs)
+
+    @property
+    def fraction(self) -> float:
+        return self.earned / self.possible if self.possible else 0.0
+
+    @property
+    def correct(self) -> int:
+        return sum(1 for _, _, is_correct in self.pairs if is_correct)
+
+    @property
+    def missing(self) -> int:
+        return sum(1 for _, j, _ in self.pairs if j is None)
+
+    @property
+    def total(self) -> int:
+        return len(self.pairs)
+
+def align_answers(answer_key: CompiledAnswerKey, student_raw: str) -> LineAlignment:
+    """
+    Match student lines to answer-key items instead of pairing them by index,
+    so one skipped or added line no longer marks every following line wrong.
+    When the key is numbered and most student lines are too, lines are matched
+    by item number; otherwise by an anchored diff over the parsed lines.
+    """
+    student_lines = student_raw.splitlines()
+    student_rows = [j for j, line in enumerate(student_lines) if line.strip()]
+    student_parsed = {j: parse_item_answer(student_lines[j]) for j in student_rows}
+    key_rows = answer_key.items
+    # A line is correct when it parses to one of the item's accepted answers
+    accepts = answer_key.accepts
+    pairs = []
+    extra = []
+
+    student_labels = {j: line_label(student_lines[j]) for j in student_rows}
+    numbered = sum(1 for label in student_labels.values() if label is not None)
+    if answer_key.labeled and student_rows and numbered * 2 >= len(student_rows):
+        # First student line carrying each item number answers that item
+        by_label = {}
+        for j in student_rows:
+            label = student_labels[j]
+            if label is not None and label not in by_label:
+                by_label[label] = j
+        used = set()
+        for i in key_rows:
+            j = by_label.get(answer_key.labels[i])
+            if j is None:
+                pairs.append((i, None, False))
+                continue
+            used.add(j)
+            pairs.append((i, j, accepts(i, student_parsed[j])))
+        extra = [j for j in student_rows if j not in used]
+    else:
+        opcodes = diff_opcodes(
+            [(answer_key.answers[i] or ("",))[0] for i in key_rows],
+            [student_parsed[j] for j in student_rows],
+        )
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal":
+                for offset in range(i2 - i1):
+                    i, j = key_rows[i1 + offset], student_rows[j1 + offset]
+                    pairs.append((i, j, accepts(i, student_parsed[j])))
+                continue
+            # "replace" pairs lines up in order; leftovers are missing or extra
+            paired = min(i2 - i1, j2 - j1)
+            for offset in range(paired):
+                i, j = key_rows[i1 + offset], student_rows[j1 + offset]
+                pairs.append((i, j, accepts(i, student_parsed[j])))
+            for i in key_rows[i1 + paired:i2]:
+                pairs.append((i, None, False))
+            extra.extend(student_rows[j1 + paired:j2])
+
+    return LineAlignment(answer_key, student_lines, pairs, extra)
+
+################################################################################
+# Generate line-by-line correctness report
+################################################################################
+def generate_line_by_line_report(alignment: LineAlignment) -> str:
+    """
+    Show every answer-key item with the student's matching line and whether
+    it is correct (✅) or wrong/missing (❌), then any extra student lines.
+    """
+    answer_key = alignment.answer_key
+    report_lines = []
+
+    for number, (i, j, is_correct) in enumerate(alignment.pairs, start=1):
+        label = answer_key.labels[i] if answer_key.labeled else number
+        if j is None:
+            report_lines.append(f"{label}. (missing) --> ❌")
+            continue
         status_symbol = "✅" if is_correct else "❌"
         # Show "1. e --> ❌"
-        line_text = f"{line_number_label} {s_line_raw.strip()} --> {status_symbol}"
+        report_lines.append(f"{label}. {alignment.student_lines[j].strip()} --> {status_symbol}")
 
-        report_lines.append(line_text)
+    for j in alignment.extra:
+        report_lines.append(f"➕ {alignment.student_lines[j].strip()} --> (extra)")
 
     return "\n".join(report_lines)
 
 
+################################################################################
+# Grading Policy
+################################################################################
+
+# "similarity": share of the answer key's distinct words found in the submission
+# "items": weighted share of answer-key items answered correctly (see align_answers)
+GRADING_MODE = "similarity"
+# Submissions scoring below this are rejected and asked to re-send
+GRADING_THRESHOLD = 0.30
+ON_TIME_POINTS = 15
+LATE_POINTS = 10
+# Scale the points by the submission's score instead of giving full points
+GRADING_PROPORTIONAL_POINTS = False
+
+class GradingPolicy:
+    """
+    Turns a submission's measured score into accept/reject and points.
+    measure() picks the score the mode grades on (None when the answer key
+    has nothing to grade against, in which case every submission is accepted).
+    """
+
+    def __init__(self, mode, threshold, on_time_points, late_points, proportional=False):
+        if mode not in ("similarity", "items"):
+            raise ValueError(f"Unknown grading mode: {mode}")
+        self.mode = mode
+        self.threshold = threshold
+        self.on_time_points = on_time_points
+        self.late_points = late_points
+        self.proportional = proportional
+
+    def measure(self, answer_key: CompiledAnswerKey, similarity: float, alignment: LineAlignment = None):
+        if self.mode == "items":
+            return alignment.fraction if alignment.possible else None
+        return similarity if answer_key.tokens else None
+
+    def accepts(self, measured) -> bool:
+        return measured is None or measured >= self.threshold
+
+    def criterion(self) -> str:
+        """The pass condition in words, for the homework instructions."""
+        percent = round(self.threshold * 100)
+        if self.mode == "items":
+            return f"at least {percent}% of the answers are correct"
+        return f"at least {percent}% overlap"
+
+    def points(self, deadline_text: str, submitted_at: datetime, measured=None) -> str:
+        points = self.on_time_points if submitted_on_time(deadline_text, submitted_at) else self.late_points
+        if self.proportional and measured is not None:
+            points *= measured
+        return str(round(points))
+
+grading = GradingPolicy(GRADING_MODE, GRADING_THRESHOLD, ON_TIME_POINTS, LATE_POINTS,
+                        proportional=GRADING_PROPORTIONAL_POINTS)
+
+
 ################################################################################
 # CHANGE #1: Remove the "Re-submit" button, keep only "/menu"
 ################################################################################
@@ -170,22 +1856,70 @@ class Registration(StatesGroup):
     editing_information = State()
     editing_field = State()
 
-def generate_unique_id(sheet, column_name="Unique ID", prefix="V3"):
-    column_data = sheet.col_values(sheet.row_values(1).index(column_name) + 1)
-    if len(column_data) > 1:  # Exclude the header
-        last_id = column_data[-1]
-        number = int(last_id[len(prefix):]) + 1
-    else:
-        number = 1
-    return f"{prefix}{number:03}"
+UNIQUE_ID_PREFIX = "V3"
+# Last issued Unique ID number, so a restart doesn't need to scan the sheet
+UNIQUE_ID_HWM_PATH = "unique_id.hwm"
+
+class UniqueIdAllocator:
+    """
+    Hands out "V3xxx" Unique IDs from an in-process counter.
+    Seeded once (from the high-water-mark file, or else from the roster's
+    Unique ID column) and persisted after every allocation.
+    allocate() never awaits, so concurrent registrations can't get the same ID.
+    """
+
+    def __init__(self, prefix, hwm_path):
+        self.prefix = prefix
+        self.hwm_path = hwm_path
+        self.last_number = None
+
+    def _parse(self, unique_id):
+        suffix = unique_id[len(self.prefix):]
+        if unique_id.startswith(self.prefix) and suffix.isdigit():
+            return int(suffix)
+        return None
+
+    def _read_hwm(self):
+        try:
+            with open(self.hwm_path, encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_hwm(self, number):
+        tmp_path = self.hwm_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(number))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.hwm_path)
+
+    def seed(self):
+        number = self._read_hwm()
+        if number is None:
+            numbers = (self._parse(unique_id) for unique_id in roster.by_unique_id)
+            number = max((n for n in numbers if n is not None), default=0)
+        self.last_number = number
+
+    def allocate(self):
+        if self.last_number is None:
+            self.seed()
+        self.last_number += 1
+        # IDs added to the sheet by hand since the last restart are skipped
+        while f"{self.prefix}{self.last_number:03}" in roster.by_unique_id:
+            self.last_number += 1
+        self._write_hwm(self.last_number)
+        return f"{self.prefix}{self.last_number:03}"
+
+id_allocator = UniqueIdAllocator(UNIQUE_ID_PREFIX, UNIQUE_ID_HWM_PATH)
 
 def find_column_indices(sheet, headers):
     sheet_headers = sheet.row_values(1)
     return {header: sheet_headers.index(header) + 1 for header in headers}
 
-def is_user_registered(sheet, telegram_id):
-    telegram_id_column = sheet.col_values(sheet.row_values(1).index("Telegram ID") + 1)
-    return str(telegram_id) in telegram_id_column
+def is_user_registered(telegram_id):
+    row_index, _ = roster.find_by_telegram_id(telegram_id)
+    return row_index is not None
 
 def back_keyboard():
     return ReplyKeyboardMarkup(
@@ -195,7 +1929,7 @@ def back_keyboard():
 
 @router.message(Command(commands=["start"]))
 async def cmd_start(message: types.Message, state: FSMContext):
-    if is_user_registered(sheet, message.from_user.id):
+    if is_user_registered(message.from_user.id):
         await message.answer("You have already registered. Use /menu to open the main page.")
         return
     await message.answer("Welcome! Please provide your full name (e.g., John Doe):", reply_markup=back_keyboard())
@@ -493,6 +2227,28 @@ async def process_hw_frequency(message: types.Message, state: FSMContext):
     await message.answer("How did you hear about us?", reply_markup=referral_kb)
     await state.set_state(Registration.waiting_for_referral)
 
+async def append_registration(new_row, telegram_id):
+    """
+    Append a registration row and index it in the roster.
+    If the append times out, the row may still land, and a retry would
+    duplicate it; so the roster is reloaded and the timeout only re-raised
+    when the student's Telegram ID isn't there.
+    """
+    try:
+        response = await sheets.call(sheet.append_row, new_row, value_input_option="RAW")
+    except TimeoutError:
+        await roster.load()
+        if roster.find_by_telegram_id(telegram_id)[0] is None:
+            raise
+        logging.warning(f"append_row for {telegram_id} timed out, but the row landed")
+        return
+    row_number = appended_row_number(response)
+    if row_number is None:
+        logging.warning(f"append_row returned no updatedRange; reloading the roster: {response}")
+        await roster.load()
+    else:
+        roster.add_row(row_number, new_row)
+
 @router.message(Registration.waiting_for_referral)
 async def process_referral(message: types.Message, state: FSMContext):
     if message.text == "Back":
@@ -523,7 +2279,7 @@ async def process_referral(message: types.Message, state: FSMContext):
     await state.update_data(referral_source=message.text)
     user_data = await state.get_data()
     username = message.from_user.username if message.from_user.username else "Not Provided"
-    unique_id = generate_unique_id(sheet)
+    unique_id = id_allocator.allocate()
     tz_tashkent = pytz.timezone("Asia/Tashkent")
     registration_time = datetime.now(tz_tashkent).strftime("%d/%m/%Y %H:%M:%S")
     await message.answer("Thank you for registering! 🎉\n\n")
@@ -545,7 +2301,7 @@ async def process_referral(message: types.Message, state: FSMContext):
     ]
 
     try:
-        sheet.append_row(new_row, value_input_option="RAW")
+        await append_registration(new_row, message.from_user.id)
         await message.answer(
             f"✨ *Your Unique ID:* {unique_id}\n",
             parse_mode="Markdown"
@@ -562,27 +2318,21 @@ async def process_referral(message: types.Message, state: FSMContext):
 # 5) Profile & Editing Handlers
 ################################################################################
 
-def find_row_by_telegram_id(sheet, telegram_id):
-    rows = sheet.get_all_values()
-    headers = rows[0]
-    telegram_id_index = headers.index("Telegram ID")
-    for i, row in enumerate(rows[1:], start=2):
-        if len(row) > telegram_id_index and row[telegram_id_index] == str(telegram_id):
-            return i, row
-    return None, None
-
-def update_google_sheets(sheet, telegram_id, field, value):
-    row_index, _ = find_row_by_telegram_id(sheet, telegram_id)
+def find_row_by_telegram_id(telegram_id):
+    return roster.find_by_telegram_id(telegram_id)
+
+async def update_google_sheets(telegram_id, field, value):
+    row_index, _ = find_row_by_telegram_id(telegram_id)
     if row_index:
-        headers = sheet.row_values(1)
-        col_index = headers.index(field) + 1
-        sheet.update_cell(row_index, col_index, value)
+        col_index = roster.headers.index(field) + 1
+        await sheets.call(sheet.update_cell, row_index, col_index, value)
+        roster.set_cell(row_index, col_index, value)
         return True
     return False
 
 @router.message(Command(commands=["edit"]))
 async def cmd_edit(message: types.Message, state: FSMContext):
-    if not is_user_registered(sheet, message.from_user.id):
+    if not is_user_registered(message.from_user.id):
         await message.answer("You are not registered yet. Use /start to register.")
         return
 
@@ -617,7 +2367,7 @@ async def edit_info_handler(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    user_row_index, user_row = find_row_by_telegram_id(sheet, message.from_user.id)
+    user_row_index, user_row = find_row_by_telegram_id(message.from_user.id)
     if not user_row:
         await message.answer("Profile not found. Please register using /start.")
         return
@@ -629,8 +2379,7 @@ async def edit_info_handler(message: types.Message, state: FSMContext):
 
     # HW Frequency only if Active
     if field == "HW Frequency":
-        study_mode_index = sheet.row_values(1).index("Study Mode")
-        if user_row[study_mode_index] != "Active":
+        if roster.get_value(user_row, "Study Mode") != "Active":
             await message.answer("HW Frequency can only be edited for Active study mode.")
             return
         hw_kb = ReplyKeyboardMarkup(
@@ -698,7 +2447,7 @@ async def save_edited_data(message: types.Message, state: FSMContext):
                     reply_markup=phone_kb
                 )
                 return
-        if update_google_sheets(sheet, message.from_user.id, "Telephone Number", phone_number):
+        if await update_google_sheets(message.from_user.id, "Telephone Number", phone_number):
             await message.answer("Your telephone number has been updated successfully.")
         else:
             await message.answer("Failed to update your telephone number. Please try again.")
@@ -742,7 +2491,7 @@ async def save_edited_data(message: types.Message, state: FSMContext):
         editing_field = "Region"
 
     # Update sheet
-    if update_google_sheets(sheet, message.from_user.id, editing_field, message.text):
+    if await update_google_sheets(message.from_user.id, editing_field, message.text):
         await message.answer(f"Your {editing_field.lower()} has been updated successfully.")
     else:
         await message.answer(f"Failed to update your {editing_field.lower()}. Please try again.")
@@ -752,11 +2501,8 @@ async def save_edited_data(message: types.Message, state: FSMContext):
 
 async def show_profile(message: types.Message):
     logging.info("Executing show_profile function")
-    telegram_id = str(message.from_user.id)
     try:
-        rows = sheet.get_all_values()
-        headers = [header.strip() for header in rows[0]]
-        logging.info(f"Fetched headers from Google Sheets: {headers}")
+        headers = roster.headers
 
         required_columns = [
             "Full Name",
@@ -773,23 +2519,22 @@ async def show_profile(message: types.Message):
             if column not in headers:
                 raise ValueError(f"Column '{column}' is missing in Google Sheets headers: {headers}")
 
-        telegram_id_col_index = headers.index("Telegram ID")
-        for row in rows[1:]:
-            if len(row) > telegram_id_col_index and row[telegram_id_col_index].strip() == telegram_id:
-                profile_info = (
-                    f"👤 *Your Profile:*\n"
-                    f"*🆔 Your ID: {row[headers.index('Unique ID')].strip()} *\n"
-                    f"- *Full Name:* {row[headers.index('Full Name')].strip()}\n"
-                    f"- *Telephone Number:* {row[headers.index('Telephone Number')].strip()}\n"
-                    f"- *Additional Telephone Number:* {row[headers.index('Additional Telephone Number')].strip()}\n"
-                    f"- *Date of Birth:* {row[headers.index('Date of Birth')].strip()}\n"
-                    f"- *Region:* {row[headers.index('Region')].strip()}\n"
-                    f"- *Study Mode:* {row[headers.index('Study Mode')].strip()}\n"
-                    f"- *HW Frequency:* {row[headers.index('HW Frequency')].strip()}\n"
-                    f"\n\n*To change data, send* /edit"
-                )
-                await message.answer(profile_info, parse_mode="Markdown")
-                return
+        _, row = roster.find_by_telegram_id(message.from_user.id)
+        if row:
+            profile_info = (
+                f"👤 *Your Profile:*\n"
+                f"*🆔 Your ID: {roster.get_value(row, 'Unique ID')} *\n"
+                f"- *Full Name:* {roster.get_value(row, 'Full Name')}\n"
+                f"- *Telephone Number:* {roster.get_value(row, 'Telephone Number')}\n"
+                f"- *Additional Telephone Number:* {roster.get_value(row, 'Additional Telephone Number')}\n"
+                f"- *Date of Birth:* {roster.get_value(row, 'Date of Birth')}\n"
+                f"- *Region:* {roster.get_value(row, 'Region')}\n"
+                f"- *Study Mode:* {roster.get_value(row, 'Study Mode')}\n"
+                f"- *HW Frequency:* {roster.get_value(row, 'HW Frequency')}\n"
+                f"\n\n*To change data, send* /edit"
+            )
+            await message.answer(profile_info, parse_mode="Markdown")
+            return
 
         await message.answer("Profile not found. Please register using /start.")
     except ValueError as ve:
@@ -826,31 +2571,20 @@ class HomeworkSubmission(StatesGroup):
     waiting_for_homework_submission = State()
 
 def get_student_fullname(telegram_id):
-    try:
-        rows = sheet.get_all_values()
-        headers = rows[0]
-        if "Full Name" not in headers or "Telegram ID" not in headers:
-            return None
-        telegram_id_idx = headers.index("Telegram ID")
-        full_name_idx = headers.index("Full Name")
-        for row in rows[1:]:
-            if len(row) > telegram_id_idx and row[telegram_id_idx].strip() == str(telegram_id):
-                return row[full_name_idx].strip()
-    except Exception as e:
-        logging.error(f"Error retrieving full name: {e}")
-    return None
+    _, row = roster.find_by_telegram_id(telegram_id)
+    if row is None or roster.column_index("Full Name") is None:
+        return None
+    return roster.get_value(row, "Full Name")
 
 @router.message(Command(commands=["homework"]))
 async def homework_command_handler(message: types.Message, state: FSMContext):
     logging.info("Homework command handler triggered")
 
-    student_data = sheet.get_all_records()
-    telegram_id_str = str(message.from_user.id)
-    student_info = next((row for row in student_data if str(row.get("Telegram ID", "")).strip() == telegram_id_str), None)
-
-    if not student_info:
+    _, student_row = roster.find_by_telegram_id(message.from_user.id)
+    if not student_row:
         await message.answer("Your information was not found. Please register using /start.")
         return
+    student_info = roster.record(student_row)
 
     unique_id = student_info.get("Unique ID")
     group_number = student_info.get("GROUP NUMBER")
@@ -860,32 +2594,21 @@ async def homework_command_handler(message: types.Message, state: FSMContext):
 
     group_sheet_name = f"G#{group_number}"
     try:
-        group_sheet = client.open_by_key("REPLACE_SHEET2_ID").worksheet(group_sheet_name)
+        snapshot = await group_cache.get(group_sheet_name)
     except gspread.exceptions.WorksheetNotFound:
         await message.answer(f"Group sheet '{group_sheet_name}' not found.")
         return
 
-    raw_data = group_sheet.get_all_values()
-    if len(raw_data) < 5:
+    if not snapshot.complete:
         await message.answer("Homework data is not available at the moment.")
         return
 
-    # row 3 => HW headers ( "1", "2", "3", ... up to "30" )
-    # row 4 => deadlines
-    # row 5 => teacher answers
-    headers = raw_data[2]   # row 3
-    row_deadlines = raw_data[3]  # row 4
-    row_answers   = raw_data[4]  # row 5
-    data_rows = raw_data[5:]     # student data from row 6 onward
+    headers = snapshot.headers
+    row_deadlines = snapshot.deadlines
+    row_answers = snapshot.answers
 
     # Find student's row by unique ID
-    student_row_number = None
-    student_row = None
-    for idx, row in enumerate(data_rows, start=6):
-        if len(row) > 0 and row[0].strip() == unique_id:
-            student_row_number = idx
-            student_row = row
-            break
+    student_row_number, student_row = snapshot.find_student(unique_id)
 
     if not student_row:
         await message.answer("Your homework record was not found in the group sheet.")
@@ -895,9 +2618,8 @@ async def homework_command_handler(message: types.Message, state: FSMContext):
     missing_homeworks = []
     for hw_num in range(1, 31):
         hw_str = str(hw_num)
-        if hw_str in headers:
-            col_index = headers.index(hw_str)
-
+        col_index = snapshot.hw_column(hw_str)
+        if col_index is not None:
             deadline_val = row_deadlines[col_index].strip() if col_index < len(row_deadlines) else ""
             answers_val  = row_answers[col_index].strip() if col_index < len(row_answers) else ""
 
@@ -918,7 +2640,7 @@ async def homework_command_handler(message: types.Message, state: FSMContext):
         reply_markup=hw_kb
     )
     await state.update_data(
-        group_sheet_key="REPLACE_SHEET2_ID",
+        group_sheet_key=GROUP_SHEETS_KEY,
         group_sheet_name=group_sheet_name,
         student_row_number=student_row_number,
         unique_id=unique_id,
@@ -954,11 +2676,11 @@ async def homework_selection_handler(message: types.Message, state: FSMContext):
         "...\n\n"
         "After submitting:\n"
         "• We'll compare it to the teacher's official answers.\n"
-        "• If at least 30% overlap, it's considered correct, otherwise you'll be asked to re-submit.\n\n"
+        f"• If {grading.criterion()}, it's considered correct, otherwise you'll be asked to re-submit.\n\n"
         "Points:\n"
-        "• 15 points if on/before deadline.\n"
-        "• 10 points if late.\n"
-        "If no deadline is set, full mark (15)."
+        f"• {grading.on_time_points} points if on/before deadline.\n"
+        f"• {grading.late_points} points if late.\n"
+        f"If no deadline is set, full mark ({grading.on_time_points})."
     )
     # Provide a Back button or /menu button at this stage
     back_or_menu_kb = ReplyKeyboardMarkup(
@@ -971,6 +2693,15 @@ async def homework_selection_handler(message: types.Message, state: FSMContext):
     await message.answer(homework_instructions, reply_markup=back_or_menu_kb)
     await state.set_state(HomeworkSubmission.waiting_for_homework_submission)
 
+def archive_submission(unique_id, group_sheet_name, hw_num, raw_text, tokens, answer_key,
+                       similarity, score, submitted_at):
+    # Every attempt is kept, accepted or not; a failure here must not block grading
+    try:
+        archive.record(unique_id, group_sheet_name, hw_num, raw_text, tokens, answer_key.raw,
+                       similarity, score, submitted_at)
+    except sqlite3.Error as e:
+        logging.error(f"Error archiving homework submission: {e}")
+
 @router.message(HomeworkSubmission.waiting_for_homework_submission)
 async def process_homework_submission(message: types.Message, state: FSMContext):
     if message.text.strip().lower() == "back":
@@ -995,7 +2726,7 @@ async def process_homework_submission(message: types.Message, state: FSMContext)
         return
 
     try:
-        group_sheet = client.open_by_key(group_sheet_key).worksheet(group_sheet_name)
+        snapshot = await group_cache.get(group_sheet_name)
     except gspread.exceptions.WorksheetNotFound:
         await message.answer(f"Group sheet '{group_sheet_name}' not found.")
         await state.clear()
@@ -1008,66 +2739,83 @@ async def process_homework_submission(message: types.Message, state: FSMContext)
         return
     col_index = homework_headers.index(hw_header_str) + 1
 
-    # Teacher’s RAW answers from row=5, col=(4 + HW#)
-    teacher_answers_raw = ""
-    try:
-        teacher_answers_raw = group_sheet.cell(5, 4 + selected_hw).value or ""
-    except Exception:
-        teacher_answers_raw = ""
+    # Teacher’s RAW answers from row=5, col=(4 + HW#), compiled once per key
+    teacher_answers_raw = snapshot.cell(5, 4 + selected_hw)
+    answer_key = answer_keys.get(group_sheet_name, selected_hw, teacher_answers_raw)
+    student_tokens = parse_tokens(message.text)
 
-    teacher_parsed = parse_text(teacher_answers_raw)
-    student_parsed = parse_text(message.text)
+    # Overall similarity, and the per-item alignment shared by grading, the summary and the report
+    similarity = answer_key.similarity(student_tokens)
+    alignment = align_answers(answer_key, message.text)
+    measured = grading.measure(answer_key, similarity, alignment)
 
-    # Overall similarity check
-    if teacher_parsed:  
-        similarity = calculate_similarity(student_parsed, teacher_parsed)
-        if similarity < 0.30:
-            # CHANGE #1: Use the "menu_only_keyboard" so no "Re-submit" is shown
-            await message.answer(
-                "Your answers do not match enough of the teacher's answers. More than 70% of your answer is wrong.\n"
-                "Please re-send your homework in the required format:\n"
-                "1. a\n"
-                "2. b\n"
-                "3. c\n"
-                "...\n\n",
-                reply_markup=menu_only_keyboard()
-            )
-            return
+    submitted_at = datetime.now(pytz.timezone("Asia/Tashkent"))
+
+    if not grading.accepts(measured):
+        archive_submission(unique_id, group_sheet_name, selected_hw, message.text, student_tokens,
+                           answer_key, similarity if answer_key.tokens else None, None, submitted_at)
+        wrong_share = round((1 - grading.threshold) * 100)
+        # CHANGE #1: Use the "menu_only_keyboard" so no "Re-submit" is shown
+        await message.answer(
+            "Your answers do not match enough of the teacher's answers. "
+            f"More than {wrong_share}% of your answer is wrong.\n"
+            "Please re-send your homework in the required format:\n"
+            "1. a\n"
+            "2. b\n"
+            "3. c\n"
+            "...\n\n",
+            reply_markup=menu_only_keyboard()
+        )
+        return
 
     # Calculate score by deadline
-    deadline_cell = group_sheet.cell(4, 4 + selected_hw).value or ""
-    score = "15"
-    if deadline_cell.strip():
-        try:
-            deadline_dt = datetime.strptime(deadline_cell.strip(), "%Y.%m.%d, %H:%M")
-            deadline_dt = pytz.timezone("Asia/Tashkent").localize(deadline_dt)
-            now = datetime.now(pytz.timezone("Asia/Tashkent"))
-            if now > deadline_dt:
-                score = "10"
-        except Exception as e:
-            logging.error(f"Error parsing deadline: {e}")
+    deadline_cell = snapshot.cell(4, 4 + selected_hw)
+    score = grading.points(deadline_cell, submitted_at, measured)
+    archive_submission(unique_id, group_sheet_name, selected_hw, message.text, student_tokens,
+                       answer_key, similarity if answer_key.tokens else None, score, submitted_at)
 
-    # Update student's cell
+    # Queue the student's cell (journaled now, written to the sheet in the next batch)
     try:
-        group_sheet.update_cell(student_row_number, col_index, score)
+        grade_queue.enqueue(group_sheet_key, group_sheet_name, student_row_number, col_index, score)
+        group_cache.set_cell(group_sheet_name, student_row_number, col_index, score)
+        score_totals.record(group_sheet_name, student_row_number, col_index, score)
     except Exception as e:
         logging.error(f"Error updating homework submission: {e}")
         await message.answer(f"An error occurred while submitting your homework: {e}")
         await state.clear()
         return
 
+    # Compare with classmates' submissions for the same homework
+    try:
+        suspects = await plagiarism.check(unique_id, group_sheet_name, selected_hw, alignment)
+    except Exception as e:
+        logging.error(f"Error checking submission for plagiarism: {e}")
+        suspects = []
+
     # Forward submission
     full_name = get_student_fullname(message.from_user.id) or "Not Provided"
-    similarity_str = (
-        f"{round(calculate_similarity(student_parsed, teacher_parsed)*100,1)}%"
-        if teacher_parsed else "N/A"
-    )
+    similarity_str = f"{round(similarity*100,1)}%" if answer_key.tokens else "N/A"
+    lines_str = ""
+    if alignment.total:
+        lines_str = f"*Correct Lines:* {alignment.correct}/{alignment.total}"
+        if alignment.missing or alignment.extra:
+            lines_str += f" (missing {alignment.missing}, extra {len(alignment.extra)})"
+        lines_str += "\n"
+        if alignment.possible != alignment.total:
+            lines_str += f"*Item Score:* {alignment.earned:g}/{alignment.possible:g}\n"
+    suspects_str = ""
+    if suspects:
+        suspects_str = "*⚠️ Possible copy of:* " + ", ".join(
+            f"{other} ({round(estimate*100)}%)" for other, estimate in suspects[:5]
+        ) + "\n"
     forward_text = (
         f"📥 *New Homework Submission!*\n\n"
         f"*Student Name:* {full_name}\n"
         f"*Telegram ID:* {message.from_user.id}\n"
         f"*Homework Number:* #{selected_hw}\n"
-        f"*Similarity:* {similarity_str}\n\n"
+        f"*Similarity:* {similarity_str}\n"
+        f"{lines_str}"
+        f"{suspects_str}\n"
         f"*Submitted Content:*\n{message.text}"
     )
     try:
@@ -1076,7 +2824,7 @@ async def process_homework_submission(message: types.Message, state: FSMContext)
         logging.error(f"Error forwarding submission to group: {e}")
 
     # Generate line-by-line report
-    line_report = generate_line_by_line_report(teacher_answers_raw, message.text)
+    line_report = generate_line_by_line_report(alignment)
 
     # Finally, send teacher answers to the student + line-by-line result
     if teacher_answers_raw:
@@ -1114,16 +2862,20 @@ async def deadline_command_handler(message: types.Message, state: FSMContext):
         await message.answer("You are not authorized to use this command. Only admins can set deadlines.")
         return
 
-    worksheets_to_check = ["G#1", "G#2", "G#3", "G#4"]
+    # Every "G#N" tab's deadline row (A4:AH4) in one values_batch_get round-trip
+    worksheets_to_check = await worksheets.group_titles(GROUP_SHEETS_KEY)
     free_deadline_options = []
+    if worksheets_to_check:
+        spreadsheet = await worksheets.spreadsheet(GROUP_SHEETS_KEY)
+        ranges = ["'{}'!A4:AH4".format(ws_name.replace("'", "''")) for ws_name in worksheets_to_check]
+        response = await sheets.call(spreadsheet.values_batch_get, ranges)
+        value_ranges = response.get("valueRanges", [])
+    else:
+        value_ranges = []
 
-    for ws_name in worksheets_to_check:
-        try:
-            ws = client.open_by_key("REPLACE_SHEET2_ID").worksheet(ws_name)
-        except gspread.exceptions.WorksheetNotFound:
-            continue
-
-        row4 = ws.row_values(4)
+    for ws_name, value_range in zip(worksheets_to_check, value_ranges):
+        rows = value_range.get("values", [])
+        row4 = list(rows[0]) if rows else []
         if len(row4) < 34:
             row4 += [""] * (34 - len(row4))
 
@@ -1180,7 +2932,7 @@ async def deadline_input_handler(message: types.Message, state: FSMContext):
         return
 
     try:
-        ws = client.open_by_key("REPLACE_SHEET2_ID").worksheet(selected_ws)
+        ws = await worksheets.get(GROUP_SHEETS_KEY, selected_ws)
     except gspread.exceptions.WorksheetNotFound:
         await message.answer(f"Worksheet {selected_ws} not found.")
         await state.clear()
@@ -1188,7 +2940,8 @@ async def deadline_input_handler(message: types.Message, state: FSMContext):
 
     col_index = 4 + selected_hw
     try:
-        ws.update_cell(4, col_index, message.text.strip())
+        await sheets.call(ws.update_cell, 4, col_index, message.text.strip())
+        group_cache.set_cell(selected_ws, 4, col_index, message.text.strip())
         await state.update_data(deadline_confirmed=True)
         await message.answer(
             f"Deadline for {selected_ws} homework #{selected_hw} has been set to {message.text.strip()}.\n\n"
@@ -1213,16 +2966,17 @@ async def teacher_answers_input_handler(message: types.Message, state: FSMContex
     selected_hw = data.get("selected_deadline_hw")
 
     teacher_raw_text = message.text.strip()
-    teacher_parsed = parse_text(teacher_raw_text)
 
     try:
-        ws = client.open_by_key("REPLACE_SHEET2_ID").worksheet(selected_ws)
-        ws.update_cell(5, 4 + selected_hw, teacher_raw_text)
+        ws = await worksheets.get(GROUP_SHEETS_KEY, selected_ws)
+        await sheets.call(ws.update_cell, 5, 4 + selected_hw, teacher_raw_text)
+        group_cache.set_cell(selected_ws, 5, 4 + selected_hw, teacher_raw_text)
+        answer_key = answer_keys.put(selected_ws, selected_hw, teacher_raw_text)
 
         await message.answer(
             f"Official answers for {selected_ws} homework #{selected_hw} are saved.\n\n"
             f"<b>Raw teacher answers:</b>\n{teacher_raw_text}\n\n"
-            f"<b>(Parsed for similarity check):</b>\n{teacher_parsed}",
+            f"<b>(Parsed for similarity check):</b>\n{answer_key.parsed}",
             parse_mode="HTML",
             reply_markup=main_menu_keyboard()
         )
@@ -1232,6 +2986,590 @@ async def teacher_answers_input_handler(message: types.Message, state: FSMContex
     await state.clear()
 
 
+################################################################################
+# Batch Regrade (Admins Only)
+################################################################################
+
+def regrade_scores(answer_key, submissions, deadline_text, policy=None):
+    """
+    Score a whole group's submissions for one homework in a single pass.
+    The answer key's tokens form a shared vocabulary; every attempt becomes
+    a bitmask over it, so its overlap with the key is one popcount.
+    In "items" mode each attempt is also aligned to the key's items.
+    `submissions` is {unique_id: [archived attempt, ...]} oldest first (rejected
+    attempts are archived too); returns {unique_id: (similarity, score)} for
+    each student's latest attempt the policy accepts, or for the latest
+    attempt with score "0" if none passes.
+    """
+    policy = policy or grading
+    vocabulary = {token: 1 << bit for bit, token in enumerate(sorted(answer_key.tokens))}
+    key_size = len(vocabulary)
+    # Writing another accepted answer of an item earns its first answer's bits
+    alternative_masks = [
+        (sum(vocabulary[token] for token in first_tokens), other_tokens)
+        for first_tokens, other_tokens in answer_key.alternative_tokens
+    ]
+    results = {}
+    for unique_id, attempts in submissions.items():
+        for submission in reversed(attempts):
+            mask = 0
+            for token in submission["tokens"]:
+                bit = vocabulary.get(token, 0)
+                if not bit and FUZZY_MAX_DISTANCE > 0:
+                    for match in answer_key.fuzzy_matches(token, FUZZY_MAX_DISTANCE):
+                        bit |= vocabulary[match]
+                mask |= bit
+            if alternative_masks:
+                student_set = set(submission["tokens"])
+                for first_mask, other_tokens in alternative_masks:
+                    if any(tokens <= student_set for tokens in other_tokens):
+                        mask |= first_mask
+            similarity = mask.bit_count() / key_size if key_size else 0.0
+            alignment = align_answers(answer_key, submission["raw_text"]) if policy.mode == "items" else None
+            measured = policy.measure(answer_key, similarity, alignment)
+            if policy.accepts(measured):
+                results[unique_id] = (similarity, policy.points(deadline_text, submission["submitted_at"], measured))
+                break
+            results.setdefault(unique_id, (similarity, "0"))
+    return results
+
+@router.message(Command(commands=["regrade"]))
+async def regrade_command_handler(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("You are not authorized to use this command.")
+        return
+
+    # /regrade G#1 5
+    parts = message.text.split()
+    if len(parts) != 3 or not parts[1].startswith("G#") or not parts[2].lstrip("#").isdigit():
+        await message.answer("Usage: /regrade G#1 5 (group sheet and homework number)")
+        return
+    group_sheet_name = parts[1]
+    hw_num = int(parts[2].lstrip("#"))
+
+    try:
+        # Re-read the tab so a key corrected directly in the sheet is picked up
+        group_cache.invalidate(group_sheet_name)
+        snapshot = await group_cache.get(group_sheet_name)
+    except gspread.exceptions.WorksheetNotFound:
+        await message.answer(f"Group sheet '{group_sheet_name}' not found.")
+        return
+
+    hw_column = snapshot.hw_column(hw_num)
+    if hw_column is None:
+        await message.answer("Homework column not found.")
+        return
+    col_index = hw_column + 1
+
+    submissions = archive.attempts_for_homework(group_sheet_name, hw_num)
+    if not submissions:
+        await message.answer(f"No stored submissions for {group_sheet_name} homework #{hw_num}.")
+        return
+
+    answer_key = answer_keys.get(group_sheet_name, hw_num, snapshot.cell(5, 4 + hw_num))
+    results = regrade_scores(answer_key, submissions, snapshot.cell(4, 4 + hw_num))
+
+    changed = 0
+    not_in_sheet = 0
+    for unique_id, (_, score) in results.items():
+        row_number, _ = snapshot.find_student(unique_id)
+        if row_number is None:
+            not_in_sheet += 1
+            continue
+        current = snapshot.cell(row_number, col_index).strip()
+        if current == score or (score == "0" and current == ""):
+            continue
+        grade_queue.enqueue(GROUP_SHEETS_KEY, group_sheet_name, row_number, col_index, score)
+        group_cache.set_cell(group_sheet_name, row_number, col_index, score)
+        score_totals.record(group_sheet_name, row_number, col_index, score)
+        changed += 1
+
+    # All changed grades go out in one batch_update
+    if changed:
+        await grade_queue.flush()
+
+    summary = (
+        f"Regraded {group_sheet_name} homework #{hw_num}.\n"
+        f"Students checked: {len(results)} ({sum(map(len, submissions.values()))} attempts)\n"
+        f"Grades changed: {changed}"
+    )
+    if not_in_sheet:
+        summary += f"\nStudents no longer in the sheet: {not_in_sheet}"
+    await message.answer(summary)
+
+@router.message(Command(commands=["history"]))
+async def history_command_handler(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("You are not authorized to use this command.")
+        return
+
+    # /history V3001
+    parts = message.text.split()
+    if len(parts) != 2:
+        await message.answer("Usage: /history V3001 (student's Unique ID)")
+        return
+    unique_id = parts[1]
+
+    submissions = archive.for_student(unique_id, limit=20)
+    if not submissions:
+        await message.answer(f"No stored submissions for {unique_id}.")
+        return
+
+    lines = [f"Last {len(submissions)} submission(s) of {unique_id}:"]
+    for submission in submissions:
+        similarity = submission["similarity"]
+        similarity_str = f"{round(similarity*100,1)}%" if similarity is not None else "N/A"
+        lines.append(
+            f"{submission['submitted_at'].strftime('%d/%m/%Y %H:%M')} | {submission['group_name']} "
+            f"#{submission['homework']} | {similarity_str} | {submission['score'] or 'rejected'}"
+        )
+    await message.answer("\n".join(lines))
+
+
+################################################################################
+# Sampling Profiler (Admins Only)
+################################################################################
+
+PROFILER_SAMPLE_INTERVAL = 0.01   # seconds between stack samples
+PROFILER_LAG_INTERVAL = 0.05      # seconds between event-loop lag probes
+PROFILER_DEFAULT_SECONDS = 30
+PROFILER_MAX_SECONDS = 300
+# A thread whose innermost frame is in one of these files is waiting, not working
+PROFILER_IDLE_FILES = ("threading.py", "queue.py", "selectors.py", "thread.py")
+# Thread and event-loop plumbing present in every stack; left out of the inclusive ranking
+PROFILER_PLUMBING_FILES = ("threading.py", "thread.py", "runners.py", "base_events.py", "events.py")
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(len(ordered) * pct / 100) - 1)]
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread with sys._current_frames() from a helper
+    thread, and the event loop's lag from a coroutine, for a fixed time.
+    Stacks are kept in folded form ("thread;outer;...;inner count"), which
+    flamegraph.pl and speedscope read directly. Only one profile runs at a time.
+    """
+
+    def __init__(self, sample_interval, lag_interval):
+        self.sample_interval = sample_interval
+        self.lag_interval = lag_interval
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def _sample(self, stop, stacks, rounds):
+        own_ident = threading.get_ident()
+        while not stop.is_set():
+            # Worker threads ("sheets_0", "sheets_1", ...) are merged by pool name
+            names = {t.ident: re.sub(r"_\d+$", "", t.name) for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            rounds[0] += 1
+            stop.wait(self.sample_interval)
+
+    async def _probe_lag(self, lag):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag.append(max(0.0, loop.time() - started - self.lag_interval))
+
+    async def profile(self, seconds):
+        """Returns (folded stacks text, summary text)."""
+        stacks = {}      # folded stack -> samples
+        rounds = [0]
+        lag = []
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(stop, stacks, rounds), name="profiler", daemon=True)
+        sampler.start()
+        probe = asyncio.create_task(self._probe_lag(lag))
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            probe.cancel()
+            await asyncio.to_thread(sampler.join)
+        folded = "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+        return folded, self.summarize(seconds, stacks, rounds[0], lag)
+
+    @staticmethod
+    def _is_idle(stack):
+        leaf = stack.rsplit(";", 1)[-1]
+        return any(f"({name}:" in leaf for name in PROFILER_IDLE_FILES)
+
+    def summarize(self, seconds, stacks, rounds, lag, top=15):
+        busy = {stack: count for stack, count in stacks.items() if not self._is_idle(stack)}
+        busy_total = sum(busy.values())
+        by_thread = {}
+        self_time = {}
+        inclusive = {}
+        for stack, count in busy.items():
+            thread, *frames = stack.split(";")
+            by_thread[thread] = by_thread.get(thread, 0) + count
+            if frames:
+                leaf = f"{frames[-1]} [{thread}]"
+                self_time[leaf] = self_time.get(leaf, 0) + count
+            for frame in set(frames):
+                if any(f"({name}:" in frame for name in PROFILER_PLUMBING_FILES):
+                    continue
+                inclusive[frame] = inclusive.get(frame, 0) + count
+
+        main_samples = sum(count for stack, count in stacks.items() if stack.startswith("MainThread;"))
+        main_busy = by_thread.get("MainThread", 0)
+        lines = [
+            f"Sampling profile: {seconds}s, {rounds} rounds every {self.sample_interval * 1000:g} ms",
+            f"Event loop thread busy in {main_busy * 100 / main_samples if main_samples else 0:.1f}% of samples",
+            f"Event loop lag: p50 {_percentile(lag, 50) * 1000:.1f} ms, p95 {_percentile(lag, 95) * 1000:.1f} ms, "
+            f"max {max(lag, default=0.0) * 1000:.1f} ms",
+            "",
+            "Busy samples by thread:",
+        ]
+        for thread, count in sorted(by_thread.items(), key=lambda item: -item[1]):
+            lines.append(f"  {count:>7}  {thread}")
+        for title, table in (("Hottest functions (self):", self_time), ("Hottest functions (inclusive):", inclusive)):
+            lines += ["", title]
+            for name, count in sorted(table.items(), key=lambda item: -item[1])[:top]:
+                lines.append(f"  {count * 100 / busy_total:5.1f}%  {name}")
+        if not busy_total:
+            lines += ["", "No busy samples: the bot was idle."]
+        return "\n".join(lines)
+
+profiler = SamplingProfiler(PROFILER_SAMPLE_INTERVAL, PROFILER_LAG_INTERVAL)
+
+async def run_profile_and_report(chat_id, seconds):
+    try:
+        folded, summary = await profiler.profile(seconds)
+        stamp = datetime.now(pytz.timezone("Asia/Tashkent")).strftime("%Y%m%d-%H%M%S")
+        await bot.send_document(
+            chat_id,
+            BufferedInputFile(folded.encode("utf-8"), filename=f"profile-{stamp}.folded"),
+            caption="Folded stacks: open in speedscope.app or pipe to flamegraph.pl",
+        )
+        # Telegram messages are limited to 4096 characters
+        await bot.send_message(chat_id, summary[:4000])
+    except Exception as e:
+        logging.error(f"Error running the sampling profiler: {e}")
+        await bot.send_message(chat_id, f"Profiling failed: {e}")
+
+@router.message(Command(commands=["profiler"]))
+async def profiler_command_handler(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("You are not authorized to use this command.")
+        return
+
+    # /profiler 30
+    parts = message.text.split()
+    if len(parts) > 2 or (len(parts) == 2 and not parts[1].isdigit()):
+        await message.answer(f"Usage: /profiler [seconds] (default {PROFILER_DEFAULT_SECONDS}, max {PROFILER_MAX_SECONDS})")
+        return
+    seconds = int(parts[1]) if len(parts) == 2 else PROFILER_DEFAULT_SECONDS
+    seconds = max(1, min(seconds, PROFILER_MAX_SECONDS))
+    if profiler.running:
+        await message.answer("A profile is already running. Please wait for its report.")
+        return
+
+    # Runs in the background so the bot keeps handling updates while it is sampled
+    profiler.task = asyncio.create_task(run_profile_and_report(message.chat.id, seconds))
+    await message.answer(f"⏱ Profiling the bot for {seconds}s; the report will be sent here.")
+
+
+################################################################################
+# Score Totals (per-student and per-group sums kept by the bot)
+################################################################################
+
+SCORE_TOTALS_FLUSH_INTERVAL = 30   # seconds between writes of changed totals to sheet2
+# Write the computed group totals to sheet2 (B = group, C = score from row 3),
+# replacing the formulas that broke with #REF! whenever tabs shifted
+SCORE_TOTALS_SHEET_SYNC = True
+# How many ranking rows the last flush wrote, so a shorter list only blanks rows the bot wrote
+SCORE_TOTALS_ROWS_PATH = "score_totals.rows"
+
+def _as_number(value) -> float:
+    """Numeric value of a score cell; blanks and text count as 0."""
+    try:
+        return float(str(value).replace(",", "").strip() or 0)
+    except ValueError:
+        return 0.0
+
+class ScoreTotals:
+    """
+    Homework points summed by the bot instead of by sheet formulas.
+    A group tab is summed once each time its snapshot loads; after that every
+    grade the bot writes adjusts the student's and the group's running sum
+    in O(1). Changed group totals go to sheet2 in one batch_update.
+    """
+
+    def __init__(self, worksheet, flush_interval, rows_path):
+        self.worksheet = worksheet
+        self.flush_interval = flush_interval
+        self.rows_path = rows_path
+        self.columns = {}   # title -> 1-based columns of HW 1..30
+        self.cells = {}     # title -> {(row, col): points}
+        self.students = {}  # title -> {row number: total}
+        self.groups = {}    # title -> total
+        self.ready = False  # every group tab has been summed at least once
+        self.dirty = False
+        self.rows_written = None  # ranking rows in B3:C written by the last flush (any run)
+        self.flushes = 0
+
+    def load_group(self, title, snapshot: GroupSnapshot):
+        """Re-sum one group tab from a freshly loaded snapshot."""
+        if not GROUP_TAB_RE.fullmatch(title):
+            return
+        # Only the first 34 columns (A-D + HW 1..30) hold scores, as in my_points
+        columns = set()
+        for hw_num in range(1, 31):
+            col_index = snapshot.hw_column(hw_num)
+            if col_index is not None and col_index < 34:
+                columns.add(col_index + 1)
+        cells = {}
+        students = {}
+        for row_number, row in snapshot.rows.items():
+            if not row or not row[0].strip():
+                continue
+            total = 0.0
+            for col in columns:
+                points = _as_number(row[col - 1]) if col <= len(row) else 0.0
+                if points:
+                    cells[(row_number, col)] = points
+                    total += points
+            students[row_number] = total
+        self.columns[title] = columns
+        self.cells[title] = cells
+        self.students[title] = students
+        group_total = sum(students.values())
+        if self.groups.get(title) != group_total:
+            self.groups[title] = group_total
+            self.dirty = True
+
+    def record(self, title, row_number, col_index, value):
+        """A grade cell was written: move both running sums by the difference."""
+        if col_index not in self.columns.get(title, ()):
+            return
+        cells = self.cells[title]
+        points = _as_number(value)
+        delta = points - cells.get((row_number, col_index), 0.0)
+        if points:
+            cells[(row_number, col_index)] = points
+        else:
+            cells.pop((row_number, col_index), None)
+        if not delta:
+            return
+        students = self.students[title]
+        students[row_number] = students.get(row_number, 0.0) + delta
+        self.groups[title] += delta
+        self.dirty = True
+
+    def ranked(self):
+        """[(group, total)] highest total first, ties by group number."""
+        ranked = sorted(self.groups.items(), key=lambda item: (-item[1], int(item[0][2:])))
+        return [(title, f"{total:g}") for title, total in ranked]
+
+    async def load_all(self):
+        """Sum every group tab (discovered from the spreadsheet, not hard-coded)."""
+        titles = await worksheets.group_titles(GROUP_SHEETS_KEY)
+        for title in titles:
+            try:
+                self.load_group(title, await group_cache.get(title))
+            except Exception as e:
+                logging.error(f"Error summing scores of {title}: {e}")
+                return
+        self.ready = True
+        logging.info(f"Score totals computed for {len(titles)} group(s)")
+
+    def _read_rows_written(self):
+        try:
+            with open(self.rows_path, encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            # Nothing recorded: don't blank rows the bot can't tell it wrote
+            return 0
+
+    def _write_rows_written(self, count):
+        tmp_path = self.rows_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(count))
+        os.replace(tmp_path, self.rows_path)
+
+    async def flush(self):
+        if not (self.ready and self.dirty):
+            return
+        self.dirty = False
+        if self.rows_written is None:
+            # A previous run may have ranked more groups than exist now
+            self.rows_written = self._read_rows_written()
+        rows = [[title, total] for title, total in self.ranked()]
+        # Blank out rows left over from a longer previous list
+        rows += [["", ""]] * max(0, self.rows_written - len(rows))
+        if not rows:
+            return
+        data = [{"range": f"B3:C{2 + len(rows)}", "values": rows}]
+        try:
+            await sheets.call(self.worksheet.batch_update, data, value_input_option="USER_ENTERED")
+            self.rows_written = len(self.groups)
+            self._write_rows_written(self.rows_written)
+            self.flushes += 1
+        except Exception as e:
+            logging.error(f"Error writing score totals: {e}")
+            self.dirty = True
+
+    async def run(self):
+        while True:
+            if not self.ready:
+                await self.load_all()
+            elif SCORE_TOTALS_SHEET_SYNC:
+                await self.flush()
+            await asyncio.sleep(self.flush_interval)
+
+    def stats(self):
+        return {
+            "groups": len(self.groups),
+            "students": sum(len(students) for students in self.students.values()),
+            "ready": self.ready,
+            "flushes": self.flushes,
+        }
+
+score_totals = ScoreTotals(sheet2, SCORE_TOTALS_FLUSH_INTERVAL, SCORE_TOTALS_ROWS_PATH)
+group_cache.listeners.append(score_totals.load_group)
+
+
+################################################################################
+# Leaderboard (ranked, pre-rendered Top List)
+################################################################################
+
+# Rendered Top List views are rebuilt after this many seconds (or as soon as grades are written)
+LEADERBOARD_TTL = 60
+
+class Leaderboard:
+    """
+    The Top List kept ranked and pre-rendered in memory.
+    Group totals come from the bot's ScoreTotals (from sheet2 until those
+    have loaded) and are re-ranked only when the TTL expires or grades were
+    written since; per-group views rank the students' running totals.
+    Each view (group, top N) is rendered once and served from memory until
+    it goes stale.
+    """
+
+    def __init__(self, worksheet, ttl):
+        self.worksheet = worksheet
+        self.ttl = ttl
+        self.groups = None      # ranked [(group, score)], entries with missing data last
+        self.loaded_at = 0.0
+        self.rendered = {}      # (group tab or None, limit) -> (message, built at)
+        self._lock = asyncio.Lock()
+        # Metrics
+        self.hits = 0
+        self.rebuilds = 0
+
+    def _fresh(self, built_at):
+        return time.monotonic() - built_at < self.ttl
+
+    def invalidate(self, titles=None):
+        """Drop views that depend on the given group tabs (all views if titles is None)."""
+        # sheet2 totals depend on every group tab
+        self.loaded_at = 0.0
+        for view in list(self.rendered):
+            if titles is None or view[0] is None or view[0] in titles:
+                del self.rendered[view]
+
+    @staticmethod
+    def _rank_groups(data):
+        """sheet2 rows (from row 3: B = group, C = score) ranked by score, broken rows last."""
+        valid_entries = []
+        missing_entries = []
+        for row in data[2:]:
+            row = list(row) + [""] * (3 - len(row))
+            group_number = row[1] if row[1] and row[1] != "#REF!" else "Not Found"
+            score = row[2] if row[2] and row[2] != "#REF!" else "❌ Data Missing"
+            if group_number != "Not Found" and score != "❌ Data Missing":
+                valid_entries.append((group_number, score))
+            else:
+                missing_entries.append((group_number, score))
+        valid_entries.sort(key=lambda entry: -_as_number(entry[1]))
+        return valid_entries + missing_entries
+
+    @staticmethod
+    def _student_totals(group_sheet_name, snapshot: GroupSnapshot):
+        """(name, total) for every student row of a group tab, highest total first."""
+        totals = []
+        for row_number, total in score_totals.students.get(group_sheet_name, {}).items():
+            row = snapshot.rows.get(row_number) or [""]
+            name = row[1].strip() if len(row) > 1 and row[1].strip() else row[0].strip()
+            totals.append((name, total))
+        totals.sort(key=lambda entry: -entry[1])
+        return [(name, f"{total:g}") for name, total in totals]
+
+    @staticmethod
+    def _render(title, column_name, entries, limit):
+        top_list = f"🏆 <b>{html.escape(title)}</b>\n"
+        top_list += "<pre>"
+        top_list += "{:<3} {:<15} {:<10}\n".format("", column_name, "Score")
+        top_list += "-" * 30 + "\n"
+        for idx, (name, score) in enumerate(entries[:limit], start=1):
+            top_list += "{:<3} {:<15} {:<10}\n".format(idx, html.escape(name), html.escape(score))
+        top_list += "</pre>"
+        return top_list
+
+    async def top_list(self, limit=None) -> str:
+        view = (None, limit)
+        cached = self.rendered.get(view)
+        if cached and self._fresh(cached[1]) and self._fresh(self.loaded_at):
+            self.hits += 1
+            return cached[0]
+        async with self._lock:
+            if self.groups is None or not self._fresh(self.loaded_at):
+                if score_totals.ready:
+                    # The bot's own running totals; no sheet read needed
+                    self.groups = score_totals.ranked()
+                else:
+                    data = await sheets.call(self.worksheet.get_all_values)
+                    self.groups = self._rank_groups(data) if len(data) > 1 else []
+                self.loaded_at = time.monotonic()
+        if not self.groups:
+            return "No data available in the sheet."
+        message = self._render("Top List", "Group Number", self.groups, limit)
+        self.rendered[view] = (message, time.monotonic())
+        self.rebuilds += 1
+        return message
+
+    async def group_list(self, group_sheet_name, limit=None) -> str:
+        view = (group_sheet_name, limit)
+        cached = self.rendered.get(view)
+        if cached and self._fresh(cached[1]):
+            self.hits += 1
+            return cached[0]
+        # Loading the snapshot (re)sums the group's totals if it had expired
+        snapshot = await group_cache.get(group_sheet_name)
+        totals = self._student_totals(group_sheet_name, snapshot)
+        if not totals:
+            return f"No students found in {group_sheet_name}."
+        message = self._render(f"Top List — {group_sheet_name}", "Student", totals, limit)
+        self.rendered[view] = (message, time.monotonic())
+        self.rebuilds += 1
+        return message
+
+    def stats(self):
+        return {"views": len(self.rendered), "hits": self.hits, "rebuilds": self.rebuilds}
+
+leaderboard = Leaderboard(sheet2, LEADERBOARD_TTL)
+# Grades written to a group tab change its students' and its own total
+grade_queue.listeners.append(leaderboard.invalidate)
+
+
 ################################################################################
 # 8) Other Commands & Features
 ################################################################################
@@ -1249,50 +3587,38 @@ async def contact_admin_command_handler(message: types.Message):
 
 async def my_points(message: types.Message):
     try:
-        telegram_id = str(message.from_user.id)
-        student_data = sheet.get_all_records()
-        student_info = next((row for row in student_data if str(row["Telegram ID"]) == telegram_id), None)
-
-        if not student_info:
+        _, student_row = roster.find_by_telegram_id(message.from_user.id)
+        if not student_row:
             await message.answer("⚠️ Your information was not found in the database.")
             return
 
+        student_info = roster.record(student_row)
         unique_id = student_info["Unique ID"]
         group_number = student_info.get("GROUP NUMBER")
-        if not group_number or not isinstance(group_number, int):
+        if not group_number or not group_number.isdigit():
             await message.answer("⚠️ Your group number is missing or invalid in the database.")
             return
 
         group_sheet_name = f"G#{group_number}"
         try:
-            group_sheet = client.open_by_key("REPLACE_SHEET2_ID").worksheet(group_sheet_name)
+            snapshot = await group_cache.get(group_sheet_name)
         except gspread.exceptions.WorksheetNotFound:
             await message.answer(f"⚠️ Group sheet '{group_sheet_name}' not found.")
             return
 
-        raw_data = group_sheet.get_all_values()
-        headers = raw_data[2]
-        rows = raw_data[3:]
-
-        filtered_headers = headers[:34]
-        filtered_rows = [row[:34] for row in rows]
-
-        student_data_list = [
-            dict(zip(filtered_headers, row)) for row in filtered_rows if len(row) == len(filtered_headers)
-        ]
-        logging.info(f"Student Data List: {student_data_list}")
-
-        student_scores = next((row for row in student_data_list if row.get('') == unique_id), None)
-        logging.info(f"Student Scores: {student_scores}")
-
+        _, student_scores = snapshot.find_student(unique_id)
         if not student_scores:
             await message.answer("⚠️ No scores were found for your account in the group sheet.")
             return
 
         scores_table = "📊 **Your Scores:**\n\n"
         for day in range(1, 31):
-            day_column = f"{day}"
-            score = student_scores.get(day_column, "0")
+            # Only the first 34 columns (A-D + HW 1..30) hold scores
+            col_index = snapshot.hw_column(day)
+            if col_index is None or col_index >= 34:
+                score = "0"
+            else:
+                score = student_scores[col_index] if col_index < len(student_scores) else ""
             scores_table += f"DAY{day:3} | {score}\n"
 
         await message.answer(scores_table, parse_mode="Markdown")
@@ -1300,49 +3626,30 @@ async def my_points(message: types.Message):
         logging.error(f"Error in 'my_points': {e}")
         await message.answer("⚠️ An error occurred while fetching your points. Please try again later.")
 
-def get_top_list():
+async def get_top_list(group_sheet_name=None, limit=None):
     try:
-        data = sheet2.get_all_values()
-        if len(data) > 1:
-            header = data[1]
-            entries = data[2:]
-
-            valid_entries = []
-            missing_entries = []
-
-            for row in entries:
-                group_number = row[1] if row[1] and row[1] != "#REF!" else "Not Found"
-                score = row[2] if row[2] and row[2] != "#REF!" else "❌ Data Missing"
-
-                if group_number != "Not Found" and score != "❌ Data Missing":
-                    valid_entries.append((group_number, score))
-                else:
-                    missing_entries.append((group_number, score))
-
-            top_list = "🏆 <b>Top List</b>\n"
-            top_list += "<pre>"
-            top_list += "{:<3} {:<15} {:<10}\n".format("", "Group Number", "Score")
-            top_list += "-" * 30 + "\n"
-
-            idx = 1
-            for group, score in valid_entries:
-                top_list += "{:<3} {:<15} {:<10}\n".format(idx, group, score)
-                idx += 1
-
-            for group, score in missing_entries:
-                top_list += "{:<3} {:<15} {:<10}\n".format(idx, group, score)
-                idx += 1
-
-            top_list += "</pre>"
-            return top_list
-        else:
-            return "No data available in the sheet."
+        if group_sheet_name:
+            return await leaderboard.group_list(group_sheet_name, limit)
+        return await leaderboard.top_list(limit)
+    except gspread.exceptions.WorksheetNotFound:
+        return f"Group sheet '{group_sheet_name}' not found."
     except Exception as e:
         return f"Error fetching top list: {e}"
 
 @router.message(Command(commands=['toplist']))
 async def send_top_list(message: types.Message):
-    await message.answer(get_top_list(), parse_mode="HTML")
+    # /toplist, /toplist 5, /toplist G#2, /toplist G#2 10
+    group_sheet_name = None
+    limit = None
+    for part in message.text.split()[1:]:
+        if part.upper().startswith("G#") and part[2:].isdigit():
+            group_sheet_name = part.upper()
+        elif part.isdigit() and int(part) > 0:
+            limit = int(part)
+        else:
+            await message.answer("Usage: /toplist [G#1] [N] (a group's students and/or the top N only)")
+            return
+    await message.answer(await get_top_list(group_sheet_name, limit), parse_mode="HTML")
 
 @router.message(Command(commands=["menu"]))
 async def menu_command_handler(message: types.Message, state: FSMContext):
@@ -1362,7 +3669,7 @@ async def profile_button_handler(message: types.Message):
 @router.message(lambda message: message.text and message.text.lower() == "top list")
 async def top_list_button_handler(message: types.Message):
     logging.info("Top List button handler triggered")
-    await message.answer(get_top_list(), parse_mode="HTML")
+    await message.answer(await get_top_list(), parse_mode="HTML")
 
 @router.message(lambda message: message.text and message.text.lower() == "homework")
 async def homework_button_handler(message: types.Message, state: FSMContext):
@@ -1390,6 +3697,29 @@ async def fallback_handler(message: types.Message):
 # 9) Admin Broadcasting Command
 ################################################################################
 
+def resolve_broadcast_targets(targets):
+    """
+    Turn the text inside {...} into a deduplicated list of chat IDs.
+    "ALL" means every registered user; otherwise a space/comma-separated list
+    of Unique IDs, each resolved with one roster index lookup.
+    Returns (chat_ids, unknown_unique_ids).
+    """
+    if targets.strip().lower() == "all":
+        return list(dict.fromkeys(roster.telegram_ids())), []
+
+    chat_ids = {}
+    unknown_ids = {}
+    for uid in re.split(r"[\s,]+", targets.strip()):
+        if not uid:
+            continue
+        _, row = roster.find_by_unique_id(uid)
+        chat_id = roster.get_value(row, "Telegram ID") if row else ""
+        if chat_id:
+            chat_ids[chat_id] = None
+        else:
+            unknown_ids[uid] = None
+    return list(chat_ids), list(unknown_ids)
+
 @router.message(Command(commands=["message"]))
 async def admin_message_handler(message: types.Message, state: FSMContext):
     if not is_admin(message.from_user.id):
@@ -1420,39 +3750,15 @@ async def admin_message_handler(message: types.Message, state: FSMContext):
             media_type = "document"
             media_file_id = message.document.file_id
 
-        if targets.lower() == "all":
-            # Send to all registered users
-            rows = sheet.get_all_values()[1:]
-            telegram_id_col_index = sheet.row_values(1).index("Telegram ID")
-            for row in rows:
-                if len(row) > telegram_id_col_index:
-                    chat_id = row[telegram_id_col_index]
-                    try:
-                        await send_message_or_media(chat_id, media_type, media_file_id, msg_content)
-                    except Exception as e:
-                        logging.error(f"Failed to send message to {chat_id}: {e}")
-            await message.answer("Message sent to all registered users.")
-        else:
-            # Targets is a space-separated list of Unique IDs
-            unique_ids = targets.split()
-            rows = sheet.get_all_values()
-            headers = rows[0]
-            unique_id_index = headers.index("Unique ID")
-            telegram_id_index = headers.index("Telegram ID")
-
-            for uid in unique_ids:
-                for row in rows[1:]:
-                    if len(row) > unique_id_index and row[unique_id_index] == uid:
-                        chat_id = row[telegram_id_index]
-                        try:
-                            await send_message_or_media(chat_id, media_type, media_file_id, msg_content)
-                            break
-                        except Exception as e:
-                            logging.error(f"Failed to send message to {chat_id}: {e}")
-                else:
-                    await message.answer(f"Unique ID {uid} not found.")
+        chat_ids, unknown_ids = resolve_broadcast_targets(targets)
+        if unknown_ids:
+            await message.answer(f"Unique ID(s) not found: {', '.join(unknown_ids)}")
+        if not chat_ids:
+            await message.answer("No recipients found. Nothing was sent.")
+            return
 
-            await message.answer("Message sent to specified users.")
+        # Delivery runs in the background; progress is posted back to this chat
+        await broadcaster.start(message.chat.id, chat_ids, media_type, media_file_id, msg_content)
     except ValueError as e:
         await message.answer(str(e))
     except Exception as e:
@@ -1460,30 +3766,234 @@ async def admin_message_handler(message: types.Message, state: FSMContext):
         await message.answer("An unexpected error occurred while processing your command.")
 
 async def send_message_or_media(chat_id, media_type, media_file_id, caption):
-    try:
-        if media_type == "photo":
-            await bot.send_photo(chat_id, photo=media_file_id, caption=caption)
-        elif media_type == "video":
-            await bot.send_video(chat_id, video=media_file_id, caption=caption)
-        elif media_type == "audio":
-            await bot.send_audio(chat_id, audio=media_file_id, caption=caption)
-        elif media_type == "document":
-            await bot.send_document(chat_id, document=media_file_id, caption=caption)
-        else:
-            await bot.send_message(chat_id, text=caption)
-    except Exception as e:
-        logging.error(f"Error while sending to chat_id {chat_id}: {e}")
+    # Errors propagate so the broadcast engine can retry / count them
+    if media_type == "photo":
+        await bot.send_photo(chat_id, photo=media_file_id, caption=caption)
+    elif media_type == "video":
+        await bot.send_video(chat_id, video=media_file_id, caption=caption)
+    elif media_type == "audio":
+        await bot.send_audio(chat_id, audio=media_file_id, caption=caption)
+    elif media_type == "document":
+        await bot.send_document(chat_id, document=media_file_id, caption=caption)
+    else:
+        await bot.send_message(chat_id, text=caption)
+
+# Telegram allows bots ~30 messages/second overall and ~1 message/second per chat
+BROADCAST_RATE = 25                 # messages per second across all chats
+BROADCAST_PER_CHAT_INTERVAL = 1.0   # seconds between two messages to the same chat
+BROADCAST_CONCURRENCY = 10          # sends in flight at once
+BROADCAST_MAX_RETRIES = 3           # RetryAfter retries per recipient
+BROADCAST_PROGRESS_INTERVAL = 5     # seconds between progress updates to the admin
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts up to `capacity`; can be paused (RetryAfter)."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class BroadcastJob:
+    def __init__(self, admin_chat_id, chat_ids, media_type, media_file_id, caption):
+        self.admin_chat_id = admin_chat_id
+        self.chat_ids = chat_ids
+        self.media_type = media_type
+        self.media_file_id = media_file_id
+        self.caption = caption
+        self.sent = 0
+        self.blocked = 0   # user blocked the bot / deleted the account
+        self.failed = 0
+        self.retries = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.sent + self.blocked + self.failed
+
+    def summary(self):
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        status = "✅ Broadcast finished" if self.finished_at else "📤 Broadcast in progress"
+        return (
+            f"{status}: {self.done}/{len(self.chat_ids)}\n"
+            f"Delivered: {self.sent}\n"
+            f"Blocked the bot: {self.blocked}\n"
+            f"Failed: {self.failed}\n"
+            f"Rate-limit retries: {self.retries}\n"
+            f"Time: {elapsed:.0f}s"
+        )
+
+class BroadcastEngine:
+    """
+    Sends /message broadcasts in the background with a bounded pool of
+    senders, a global token bucket and a per-chat interval, backing off
+    automatically on Telegram's RetryAfter. Progress is reported to the
+    admin by editing one status message.
+    """
+
+    def __init__(self, rate, per_chat_interval, concurrency, max_retries, progress_interval):
+        self.bucket = TokenBucket(rate, rate)
+        self.per_chat_interval = per_chat_interval
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self.last_sent = {}  # chat_id -> time.monotonic() of the last send
+        self.jobs = set()
+        self._tasks = set()
+
+    async def start(self, admin_chat_id, chat_ids, media_type, media_file_id, caption):
+        job = BroadcastJob(admin_chat_id, chat_ids, media_type, media_file_id, caption)
+        status = await bot.send_message(admin_chat_id, job.summary())
+        task = asyncio.create_task(self._run(job, status.message_id))
+        self.jobs.add(job)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def queued(self):
+        return sum(len(job.chat_ids) - job.done for job in self.jobs)
+
+    async def _run(self, job, status_message_id):
+        # One shared iterator: each sender pulls the next recipient when it is free
+        recipients = iter(job.chat_ids)
+        reporter = asyncio.create_task(self._report_progress(job, status_message_id))
+        try:
+            workers = [asyncio.create_task(self._worker(job, recipients))
+                       for _ in range(min(self.concurrency, len(job.chat_ids)))]
+            await asyncio.gather(*workers)
+        finally:
+            job.finished_at = time.monotonic()
+            reporter.cancel()
+            self.jobs.discard(job)
+            self._forget_old_chats()
+        logging.info(f"Broadcast finished: {job.sent} sent, {job.blocked} blocked, {job.failed} failed")
+        await self._edit_status(job, status_message_id)
+
+    async def _worker(self, job, recipients):
+        for chat_id in recipients:
+            await self._deliver(job, chat_id)
+
+    async def _deliver(self, job, chat_id):
+        for _ in range(self.max_retries + 1):
+            wait = self.last_sent.get(chat_id, float("-inf")) + self.per_chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.bucket.acquire()
+            self.last_sent[chat_id] = time.monotonic()
+            try:
+                await send_message_or_media(chat_id, job.media_type, job.media_file_id, job.caption)
+                job.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                # Flood control applies to the whole bot, so every sender backs off
+                job.retries += 1
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                job.blocked += 1
+                return
+            except Exception as e:
+                logging.error(f"Failed to send message to {chat_id}: {e}")
+                job.failed += 1
+                return
+        logging.error(f"Giving up on {chat_id} after {self.max_retries} rate-limit retries")
+        job.failed += 1
+
+    async def _report_progress(self, job, status_message_id):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._edit_status(job, status_message_id)
+
+    async def _edit_status(self, job, status_message_id):
+        try:
+            await bot.edit_message_text(job.summary(), chat_id=job.admin_chat_id, message_id=status_message_id)
+        except Exception as e:
+            # e.g. "message is not modified" when nothing changed since the last update
+            logging.debug(f"Could not update broadcast status: {e}")
+
+    def _forget_old_chats(self):
+        cutoff = time.monotonic() - self.per_chat_interval
+        self.last_sent = {chat_id: ts for chat_id, ts in self.last_sent.items() if ts > cutoff}
+
+broadcaster = BroadcastEngine(
+    BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL, BROADCAST_CONCURRENCY,
+    BROADCAST_MAX_RETRIES, BROADCAST_PROGRESS_INTERVAL,
+)
 
 
 ################################################################################
 # 10) Main Entrypoint
 ################################################################################
 
+# Gauges are read at scrape time from the objects that already track these numbers
+metrics.gauge("fsm_conversations", "Conversations currently in each FSM state.",
+              lambda: {(state,): count for state, count in storage.state_counts().items()}, ("state",))
+metrics.gauge("sheets_gateway_calls", "Sheets calls waiting for a worker or running.",
+              lambda: {("queued",): sheets.stats()["queued"], ("in_flight",): sheets.stats()["in_flight"]},
+              ("state",))
+metrics.gauge("sheets_gateway_calls_total", "Sheets calls finished since start, by result.",
+              lambda: {(result,): sheets.stats()[result] for result in ("completed", "failed", "timed_out")},
+              ("result",), kind="counter")
+metrics.gauge("grade_queue_pending_cells", "Grades journaled but not yet written to the sheet.",
+              grade_queue.pending_count)
+metrics.gauge("grade_queue_cells_written_total", "Grade cells written to the sheet since start.",
+              lambda: grade_queue.cells_written, kind="counter")
+metrics.gauge("broadcast_pending_messages", "Broadcast messages not yet delivered.", broadcaster.queued)
+metrics.gauge("roster_rows", "Registered students held in the roster index.", lambda: len(roster.rows))
+
+async def on_startup():
+    router.message.middleware(HandlerTimingMiddleware())
+    bot.session.middleware(TelegramTimingMiddleware())
+    if METRICS_PORT:
+        await metrics_server.start()
+    await roster.load()
+    logging.info(f"Roster loaded: {len(roster.rows)} registered rows")
+    id_allocator.seed()
+    background_tasks.append(asyncio.create_task(roster.refresh_periodically(ROSTER_REFRESH_INTERVAL)))
+    grade_queue.replay_journal()
+    background_tasks.append(asyncio.create_task(grade_queue.run()))
+    background_tasks.append(asyncio.create_task(score_totals.run()))
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    # Push out grades still waiting for the next batch
+    if grade_queue.pending:
+        await grade_queue.flush()
+    if SCORE_TOTALS_SHEET_SYNC:
+        await score_totals.flush()
+    sheets.shutdown()
+    await metrics_server.close()
+    await storage.close()
+    archive.close()
+
 async def main():
     dp.include_router(router)
+    await on_startup()
     await bot.delete_webhook(drop_pending_updates=True)
     logging.info("Bot is starting polling...")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await on_shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())